@@ -1,19 +1,245 @@
+import gzip
 import hashlib
 import logging
+import math
+import mmap
 import os
 import pickle
 import shutil
-from collections import defaultdict
+import sqlite3
+import struct
+import threading
+import weakref
+import zlib
+from collections import OrderedDict, defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timezone
-from time import time
+from time import perf_counter, time
 
-import scrapy
 from scrapy.extensions.httpcache import DummyPolicy, FilesystemCacheStorage
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.statscollectors import DummyStatsCollector
+from scrapy.utils.log import failure_to_exc_info
+from scrapy.utils.misc import load_object
+from scrapy.utils.project import data_path
 from scrapy.utils.python import to_bytes
 from scrapy.utils.request import fingerprint
+from twisted.internet import defer
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+from w3lib.http import headers_dict_to_raw, headers_raw_to_dict
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import fcntl
+except ImportError:
+    # Packs are not locked against other processes.
+    fcntl = None
 
 logger = logging.getLogger(__name__)
 
+# Codecs used to compress bodies of cache entries. The id of the codec is stored
+# with every entry so entries stay readable if the codec setting changes.
+_CODECS = {"none": 0, "gzip": 1, "zstd": 2}
+# Compressing small bodies is not worth it.
+_COMPRESS_MIN_SIZE = 256
+
+
+def _get_codec(settings):
+    name = settings.get("HTTPCACHE_COMPRESSION", "none")
+    if name not in _CODECS:
+        raise ValueError(f"Unknown cache compression '{name}'")
+    if name == "zstd" and zstandard is None:
+        logger.warning("zstandard is not installed, using gzip instead of zstd.")
+        name = "gzip"
+    return _CODECS[name]
+
+
+def _compress(codec, data):
+    """Return codec and compressed data."""
+    if len(data) < _COMPRESS_MIN_SIZE:
+        return _CODECS["none"], data
+    if codec == _CODECS["gzip"]:
+        return codec, gzip.compress(data, compresslevel=6)
+    if codec == _CODECS["zstd"]:
+        return codec, zstandard.ZstdCompressor().compress(data)
+    return _CODECS["none"], data
+
+
+def _decompress(codec, data):
+    if codec == _CODECS["gzip"]:
+        return gzip.decompress(data)
+    if codec == _CODECS["zstd"]:
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read this cache entry")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return bytes(data)
+
+
+class CleanupStats:
+    """Numbers reported by a cache cleanup."""
+
+    def __init__(self, scanned=0, removed=0, bytes_freed=0):
+        # Entries that were looked at.
+        self.scanned = scanned
+        # Entries (or files) that were removed.
+        self.removed = removed
+        self.bytes_freed = bytes_freed
+
+    def __str__(self):
+        return (
+            f"scanned {self.scanned} entries, removed {self.removed}, "
+            f"freed {self.bytes_freed} bytes"
+        )
+
+
+# Fingerprints of requests that are alive, see cache_fingerprint().
+_fingerprints = weakref.WeakKeyDictionary()
+
+
+def cache_fingerprint(request, spider):
+    """Return the fingerprint of a request that is used as its cache key.
+
+    How cookies affect the fingerprint depends on the cache_cookie_policy
+    attribute of the spider:
+
+      - "include" (default): The Cookie header is part of the fingerprint.
+      - "names": Only the names of the cookies are part of the fingerprint. A new
+        session (e.g. after logging in again) doesn't invalidate cached entries
+        but entries for logged-in and anonymous requests are still kept apart.
+      - "ignore": Cookies are not part of the fingerprint.
+
+    The fingerprint is computed once per request and reused by the middlewares
+    and cache storages as long as the Cookie header doesn't change.
+    """
+    policy = getattr(spider, "cache_cookie_policy", "include")
+    cookies = request.headers.getlist("Cookie")
+    memo = _fingerprints.get(request)
+    if memo is not None and memo[0] == policy and memo[1] == cookies:
+        return memo[2]
+    fpr = _compute_cache_fingerprint(request, policy, cookies)
+    _fingerprints[request] = (policy, cookies, fpr)
+    return fpr
+
+
+def _compute_cache_fingerprint(request, policy, cookies):
+    if policy == "include":
+        return fingerprint(request, include_headers=["Cookie"])
+    if policy == "ignore":
+        return fingerprint(request)
+    if policy != "names":
+        raise ValueError(f"Unknown cache cookie policy {policy!r}")
+    names = sorted(
+        {
+            cookie.split(b"=", 1)[0].strip()
+            for header in cookies
+            for cookie in header.split(b";")
+            if cookie.strip()
+        }
+    )
+    if not names:
+        return fingerprint(request)
+    return hashlib.sha1(fingerprint(request) + b"|" + b";".join(names)).digest()
+
+
+class FingerprintChain:
+    """Immutable chain of the fingerprints of a request and its parents.
+
+    A new request only links to the chain of its parent request instead of
+    copying it. Requests of a crawl therefore share the fingerprints of common
+    parents (e.g. the index page) and adding a fingerprint is cheap regardless
+    of how deep the chain is.
+    """
+
+    __slots__ = ("fingerprint", "parent")
+
+    def __init__(self, fingerprint, parent=None):
+        self.fingerprint = fingerprint
+        self.parent = parent
+
+    def __iter__(self):
+        """Iterate over the fingerprints from the oldest parent to this one."""
+        fingerprints = []
+        chain = self
+        while chain is not None:
+            fingerprints.append(chain.fingerprint)
+            chain = chain.parent
+        return reversed(fingerprints)
+
+    def __repr__(self):
+        return "FingerprintChain([{}])".format(", ".join(fpr.hex() for fpr in self))
+
+
+def _parent_fingerprints(request):
+    """Return the hex fingerprints of the parents of a request.
+
+    The last fingerprint of the chain is the fingerprint of the request itself.
+    """
+    chain = request.meta.get("fingerprints")
+    if chain is None or chain.parent is None:
+        return []
+    return [fpr.hex() for fpr in chain.parent]
+
+
+class FeedsCacheStats:
+    """Counters and latencies of cache operations of a crawler.
+
+    Counters are written to the stats of the crawler right away. Latencies are
+    collected per operation and their percentiles are written when the spider is
+    closed. Nothing is recorded if stats are not collected.
+    """
+
+    _instances = weakref.WeakKeyDictionary()
+
+    def __init__(self, stats):
+        self.stats = stats
+        self._latencies = defaultdict(list)
+
+    @classmethod
+    def for_spider(cls, spider):
+        """Return the cache stats shared by everything used by the spider."""
+        stats = getattr(getattr(spider, "crawler", None), "stats", None)
+        if stats is None or isinstance(stats, DummyStatsCollector):
+            return _NO_CACHE_STATS
+        try:
+            return cls._instances[stats]
+        except KeyError:
+            cls._instances[stats] = cls(stats)
+            return cls._instances[stats]
+
+    def inc(self, key, count=1):
+        if self.stats is not None:
+            self.stats.inc_value(f"feeds_cache/{key}", count)
+
+    @contextmanager
+    def timed(self, operation):
+        if self.stats is None:
+            yield
+            return
+        start = perf_counter()
+        yield
+        self._latencies[operation].append(perf_counter() - start)
+
+    def close(self):
+        """Write percentiles of the latencies to the stats."""
+        for operation, latencies in self._latencies.items():
+            latencies.sort()
+            for percentile in (50, 99):
+                index = round(percentile / 100 * (len(latencies) - 1))
+                self.stats.set_value(
+                    f"feeds_cache/{operation}/p{percentile}_ms",
+                    round(latencies[index] * 1000, 3),
+                )
+
+
+_NO_CACHE_STATS = FeedsCacheStats(None)
+
 
 class FeedsCachePolicy(DummyPolicy):
     def should_cache_response(self, response, request):
@@ -22,185 +248,2231 @@ class FeedsCachePolicy(DummyPolicy):
 
 
 class FeedsCache:
+    """Cache for objects of spiders.
+
+    Objects are kept in one FeedsCacheObjectStore per spider which is loaded once
+    and written back when the spider is closed. Recently used objects are kept
+    unpickled in a size-bounded LRU cache.
+    """
+
     def __init__(self, settings):
+        memory_limit = settings.getint("FEEDS_CONFIG_CACHE_MEMORY_LIMIT") * 1024 * 1024
         if settings.getbool("HTTPCACHE_ENABLED"):
-            self.storage = FeedsCacheStorage(settings)
+            self.storage = load_object(settings["HTTPCACHE_STORAGE"])(settings)
+            self.cachedir = data_path(settings["HTTPCACHE_DIR"])
         else:
-            self.storage = FeedsCacheInMemoryStorage()
+            self.storage = FeedsCacheInMemoryStorage(memory_limit)
+            self.cachedir = None
+        self.expiration_secs = settings.getint("HTTPCACHE_EXPIRATION_SECS")
+        self._stores = {}
+        self._lru = FeedsCacheLRU(memory_limit)
+
+    def _get_store(self, spider_name):
+        store = self._stores.get(spider_name)
+        if store is None:
+            store = FeedsCacheObjectStore(
+                os.path.join(self.cachedir, spider_name, "objects"),
+                self.expiration_secs,
+            )
+            self._stores[spider_name] = store
+        return store
 
     def get(self, spider, key):
-        return self.storage.retrieve_object(spider, key)
+        stats = FeedsCacheStats.for_spider(spider)
+        stats.inc("object_get")
+        with stats.timed("object_get"):
+            obj = self._get(spider, key)
+        if obj is not None:
+            stats.inc("object_hit")
+        return obj
+
+    def _get(self, spider, key):
+        if self.cachedir is None:
+            return self.storage.retrieve_object(spider, key)
+        obj = self._lru.get((spider.name, key))
+        if obj is not None:
+            return obj
+        store = self._get_store(spider.name)
+        data = store.get(key)
+        if data is not None:
+            obj = pickle.loads(data)
+            self._lru.set((spider.name, key), obj, len(data))
+        elif store.may_have_legacy_objects:
+            # Objects stored by older versions are moved to the object store.
+            obj = self.storage.retrieve_object(spider, key)
+            if obj is not None:
+                self.set(spider, key, obj)
+        return obj
 
     def set(self, spider, key, obj):
-        return self.storage.store_object(spider, key, obj)
+        FeedsCacheStats.for_spider(spider).inc("object_set")
+        if self.cachedir is None:
+            return self.storage.store_object(spider, key, obj)
+        size = self._get_store(spider.name).set(key, obj)
+        self._lru.set((spider.name, key), obj, size)
 
     def setdefault(self, spider, key, default_obj):
-        obj = self.storage.retrieve_object(spider, key)
+        obj = self.get(spider, key)
         if obj is not None:
             return obj
-        self.storage.store_object(spider, key, default_obj)
+        self.set(spider, key, default_obj)
         return default_obj
 
-    def cleanup(self):
-        self.storage.cleanup()
+    def close_spider(self, spider):
+        store = self._stores.pop(spider.name, None)
+        if store is not None:
+            store.flush()
+        FeedsCacheStats.for_spider(spider).close()
+
+    def cleanup(self, spiders=None, min_interval=0):
+        """Remove expired cache entries and objects and return CleanupStats.
+
+        If spiders is given, only the cache of these spiders is cleaned up and
+        spiders that were cleaned up less than min_interval seconds ago are
+        skipped.
+        """
+        stats = CleanupStats()
+        if self.cachedir is None:
+            return stats
+        if spiders is not None:
+            spiders = [s for s in spiders if self._cleanup_due(s, min_interval)]
+            if not spiders:
+                logger.debug("Skipping cache cleanup, cleaned up recently.")
+                return stats
+        stats = self.storage.cleanup(spiders) or stats
+        logger.info(f"Cleaned up cache: {stats}")
+        if not os.path.isdir(self.cachedir):
+            return stats
+        if spiders is None:
+            spider_names = os.listdir(self.cachedir)
+        else:
+            spider_names = spiders
+        for spider_name in sorted(spider_names):
+            if os.path.isfile(os.path.join(self.cachedir, spider_name, "objects")):
+                # Expired objects are dropped when the store is written.
+                self._get_store(spider_name).flush(force=True)
+                del self._stores[spider_name]
+            if spiders is not None:
+                self._touch_cleanup_stamp(spider_name)
+        return stats
+
+    def _get_cleanup_stamp_path(self, spider_name):
+        return os.path.join(self.cachedir, spider_name, "cleaned")
+
+    def _cleanup_due(self, spider_name, min_interval):
+        try:
+            mtime = os.path.getmtime(self._get_cleanup_stamp_path(spider_name))
+        except FileNotFoundError:
+            return True
+        return time() - mtime >= min_interval
+
+    def _touch_cleanup_stamp(self, spider_name):
+        path = self._get_cleanup_stamp_path(spider_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "a"):
+            os.utime(path)
+
+
+class FeedsCacheObjectStore:
+    """Objects of a spider kept in a single file.
+
+    The file is loaded into memory on first use and written back in one go by
+    flush(). Objects are kept pickled and expire after expiration_secs.
+    """
+
+    # Flushes of stores of the same file are serialized, e.g. the store of a
+    # running spider and the one of a cleanup in the background.
+    _locks = defaultdict(threading.Lock)
+    _locks_lock = threading.Lock()
+
+    def __init__(self, path, expiration_secs):
+        self.path = path
+        self.expiration_secs = expiration_secs
+        self._objects = None
+        self._created = None
+        self._dirty = False
+
+    def _load(self):
+        if self._objects is not None:
+            return
+        try:
+            with open(self.path, "rb") as f:
+                data = pickle.load(f)
+            self._objects, self._created = data["objects"], data["created"]
+        except FileNotFoundError:
+            self._objects, self._created = {}, time()
+
+    @property
+    def may_have_legacy_objects(self):
+        """True if objects stored by older versions might not be expired yet."""
+        self._load()
+        return time() < self._created + self.expiration_secs
+
+    def get(self, key):
+        """Return the pickled object or None."""
+        self._load()
+        try:
+            return self._objects[key][1]
+        except KeyError:
+            return None
+
+    def set(self, key, obj):
+        """Store obj and return the size of the pickled object."""
+        self._load()
+        data = pickle.dumps(obj)
+        self._objects[key] = (time(), data)
+        self._dirty = True
+        return len(data)
+
+    def flush(self, force=False):
+        if not self._dirty and not force:
+            return
+        with self._locks_lock:
+            lock = self._locks[self.path]
+        with lock:
+            self._load()
+            threshold = time() - self.expiration_secs
+            objects = {
+                key: value
+                for key, value in self._objects.items()
+                if value[0] >= threshold
+            }
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # Write to a temporary file first to not lose the store if interrupted.
+            with open(f"{self.path}.tmp", "wb") as f:
+                pickle.dump(
+                    {"created": self._created, "objects": objects}, f, protocol=4
+                )
+            os.replace(f"{self.path}.tmp", self.path)
+        self._objects = objects
+        self._dirty = False
+
+
+_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    spider TEXT NOT NULL,
+    key TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    cache_expires REAL,
+    status INTEGER,
+    blob TEXT,
+    size INTEGER NOT NULL DEFAULT 0,
+    last_access REAL,
+    PRIMARY KEY (spider, key)
+);
+CREATE INDEX IF NOT EXISTS entries_timestamp ON entries (timestamp);
+CREATE INDEX IF NOT EXISTS entries_expires ON entries (timestamp + cache_expires);
+CREATE INDEX IF NOT EXISTS entries_status ON entries (status);
+CREATE INDEX IF NOT EXISTS entries_access
+    ON entries (spider, coalesce(last_access, timestamp));
+CREATE TABLE IF NOT EXISTS parents (
+    spider TEXT NOT NULL,
+    key TEXT NOT NULL,
+    parent TEXT NOT NULL,
+    PRIMARY KEY (spider, key, parent)
+);
+-- Created by older versions, parents are only looked up by child.
+DROP INDEX IF EXISTS parents_parent;
+CREATE TABLE IF NOT EXISTS blobs (
+    hash TEXT PRIMARY KEY,
+    refcount INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS blobs_unreferenced ON blobs (hash) WHERE refcount <= 0;
+"""
+
+# Columns added to the entries table after it was created. Indexes of older
+# versions get them before the indexes on them are created.
+_INDEX_ADDED_COLUMNS = {
+    "blob": "TEXT",
+    "size": "INTEGER NOT NULL DEFAULT 0",
+    "last_access": "REAL",
+}
+
+# Entries are collected in temporary tables while the index is rebuilt.
+_INDEX_BUILD_SCHEMA = """
+CREATE TEMP TABLE IF NOT EXISTS build_entries (
+    spider TEXT NOT NULL,
+    key TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    cache_expires REAL,
+    status INTEGER,
+    blob TEXT,
+    size INTEGER NOT NULL,
+    PRIMARY KEY (spider, key)
+);
+CREATE TEMP TABLE IF NOT EXISTS build_parents (
+    spider TEXT NOT NULL,
+    key TEXT NOT NULL,
+    parent TEXT NOT NULL,
+    PRIMARY KEY (spider, key, parent)
+);
+DELETE FROM build_entries;
+DELETE FROM build_parents;
+"""
+
+# Bump if the index needs to be rebuilt from the cache entries.
+_INDEX_VERSION = 4
+
+
+class FeedsCacheIndex:
+    """Persistent index of the entries of a FeedsCacheStorage.
+
+    The index keeps the expiry information of every entry in an SQLite database
+    so that cleanup only has to visit entries that are actually due instead of
+    walking and unpickling the whole cache. It also keeps the relation between
+    child and parent entries (in both directions) so that cascading removals
+    don't have to read the metadata of every entry involved, and the reference
+    counts of deduplicated bodies.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._db = sqlite3.connect(self.path, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            # Outdated indexes are kept (other processes may be using them) and
+            # replaced by the next cleanup, see rebuild().
+            self._migrate()
+        return self._db
+
+    def _migrate(self):
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(entries)")]
+        for column, definition in _INDEX_ADDED_COLUMNS.items():
+            if columns and column not in columns:
+                self._db.execute(
+                    f"ALTER TABLE entries ADD COLUMN {column} {definition}"
+                )
+        self._db.executescript(_INDEX_SCHEMA)
+
+    @property
+    def built(self):
+        """True if the index covers all entries of the cache."""
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        return version == _INDEX_VERSION
+
+    def mark_built(self):
+        self.db.execute(f"PRAGMA user_version = {_INDEX_VERSION}")
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def rebuild(self, entries, unreferenced_blobs):
+        """Replace the index with the entries of the cache.
+
+        entries yields spider name, key, timestamp, cache_expires, status, blob,
+        size and parents of every entry of the cache. They are collected in
+        temporary tables and replace the index in a single transaction that also
+        marks the index as built. Entries that are stored by other connections
+        while the cache is read are kept.
+        """
+        started = time()
+        db = self.db
+        db.executescript(_INDEX_BUILD_SCHEMA)
+        with db:
+            db.execute("BEGIN")
+            for *entry, parents in entries:
+                db.execute(
+                    "INSERT OR REPLACE INTO build_entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    entry,
+                )
+                db.executemany(
+                    "INSERT OR IGNORE INTO build_parents VALUES (?, ?, ?)",
+                    ((entry[0], entry[1], parent) for parent in parents),
+                )
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("DELETE FROM entries WHERE timestamp < ?", (started,))
+            db.execute(
+                "INSERT OR IGNORE INTO entries "
+                "(spider, key, timestamp, cache_expires, status, blob, size) "
+                "SELECT * FROM build_entries"
+            )
+            db.execute("INSERT OR IGNORE INTO parents SELECT * FROM build_parents")
+            db.execute(
+                "DELETE FROM parents WHERE NOT EXISTS (SELECT 1 FROM entries "
+                "WHERE entries.spider = parents.spider AND entries.key = parents.key)"
+            )
+            db.execute("DELETE FROM blobs")
+            db.execute(
+                "INSERT INTO blobs SELECT blob, COUNT(*) FROM entries "
+                "WHERE blob IS NOT NULL GROUP BY blob"
+            )
+            db.executemany(
+                "INSERT OR IGNORE INTO blobs VALUES (?, 0)",
+                ((blob,) for blob in unreferenced_blobs),
+            )
+            db.execute(f"PRAGMA user_version = {_INDEX_VERSION}")
+        db.executescript("DELETE FROM build_entries; DELETE FROM build_parents;")
+
+    def add(
+        self,
+        spider_name,
+        key,
+        timestamp,
+        cache_expires=None,
+        status=None,
+        blob=None,
+        size=0,
+    ):
+        with self.db:
+            self.db.execute("BEGIN")
+            old_blob = self._blob(spider_name, key)
+            self.db.execute(
+                "INSERT OR REPLACE INTO entries "
+                "(spider, key, timestamp, cache_expires, status, blob, size) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (spider_name, key, timestamp, cache_expires, status, blob, size),
+            )
+            if blob != old_blob:
+                self._release_blob(old_blob)
+                if blob is not None:
+                    self.db.execute(
+                        "INSERT INTO blobs VALUES (?, 1) ON CONFLICT (hash) "
+                        "DO UPDATE SET refcount = refcount + 1",
+                        (blob,),
+                    )
+
+    def touch(self, spider_name, key, timestamp):
+        """Record that an entry was accessed at timestamp."""
+        self.db.execute(
+            "UPDATE entries SET last_access = ? WHERE spider = ? AND key = ?",
+            (timestamp, spider_name, key),
+        )
+
+    def sizes(self):
+        """Return the size of the entries of every spider."""
+        return dict(
+            self.db.execute("SELECT spider, SUM(size) FROM entries GROUP BY spider")
+        )
+
+    def least_recently_used(self, spider_name=None):
+        """Return spider, key and size of entries, least recently used first.
+
+        Entries that were never accessed are ordered by the time they were
+        stored. If spider_name is given, only entries of this spider are returned.
+        """
+        if spider_name is None:
+            return self.db.execute(
+                "SELECT spider, key, size FROM entries "
+                "ORDER BY coalesce(last_access, timestamp)"
+            )
+        return self.db.execute(
+            "SELECT spider, key, size FROM entries WHERE spider = ? "
+            "ORDER BY coalesce(last_access, timestamp)",
+            (spider_name,),
+        )
+
+    def remove(self, spider_name, key):
+        self.remove_many([(spider_name, key)])
+
+    def remove_many(self, entries):
+        """Remove entries given as (spider name, key) in one transaction."""
+        with self.db:
+            self.db.execute("BEGIN")
+            for spider_name, key in entries:
+                self._release_blob(self._blob(spider_name, key))
+                self.db.execute(
+                    "DELETE FROM entries WHERE spider = ? AND key = ?",
+                    (spider_name, key),
+                )
+                self.db.execute(
+                    "DELETE FROM parents WHERE spider = ? AND key = ?",
+                    (spider_name, key),
+                )
+
+    def _blob(self, spider_name, key):
+        row = self.db.execute(
+            "SELECT blob FROM entries WHERE spider = ? AND key = ?", (spider_name, key)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _release_blob(self, blob):
+        if blob is not None:
+            self.db.execute(
+                "UPDATE blobs SET refcount = refcount - 1 WHERE hash = ?", (blob,)
+            )
+
+    def unreferenced_blobs(self):
+        """Return hashes of bodies that are no longer used by any entry."""
+        return [
+            row[0]
+            for row in self.db.execute("SELECT hash FROM blobs WHERE refcount <= 0")
+        ]
+
+    def remove_blob(self, blob):
+        """Remove a blob if it is still unreferenced and return True if it was."""
+        return (
+            self.db.execute(
+                "DELETE FROM blobs WHERE hash = ? AND refcount <= 0", (blob,)
+            ).rowcount
+            > 0
+        )
+
+    def add_parents(self, spider_name, key, parents):
+        self.db.executemany(
+            "INSERT OR IGNORE INTO parents VALUES (?, ?, ?)",
+            ((spider_name, key, parent) for parent in parents),
+        )
+
+    def parents(self, spider_name, key):
+        """Return the fingerprints of all parents of an entry."""
+        return [
+            row[0]
+            for row in self.db.execute(
+                "SELECT parent FROM parents WHERE spider = ? AND key = ?",
+                (spider_name, key),
+            )
+        ]
+
+    def expired(self, now, expiration_secs, spiders=None):
+        """Return entries whose expiration date is before now."""
+        # Both queries are answered from an index, so only due entries are read.
+        spider_clause, spider_params = _spider_clause(spiders)
+        return self.db.execute(
+            "SELECT spider, key FROM entries WHERE timestamp < ?{0} "
+            "UNION SELECT spider, key FROM entries "
+            "WHERE timestamp + cache_expires < ?{0}".format(spider_clause),
+            [now - expiration_secs, *spider_params, now, *spider_params],
+        ).fetchall()
+
+    def with_status(self, codes, spiders=None, stored_before=None):
+        """Return response entries with one of the given status codes.
+
+        If stored_before is given, only entries stored before are returned.
+        """
+        if not codes:
+            return []
+        spider_clause, spider_params = _spider_clause(spiders)
+        if stored_before is not None:
+            spider_clause += " AND timestamp < ?"
+            spider_params.append(stored_before)
+        return self.db.execute(
+            "SELECT spider, key FROM entries WHERE status IN ({}){}".format(
+                ", ".join("?" * len(codes)), spider_clause
+            ),
+            [*codes, *spider_params],
+        ).fetchall()
+
+
+def _spider_clause(spiders):
+    """Return a SQL condition and its parameters restricting rows to spiders.
+
+    If spiders is None, rows are not restricted.
+    """
+    if spiders is None:
+        return "", []
+    return " AND spider IN ({})".format(", ".join("?" * len(spiders))), list(spiders)
+
+
+# A cache record consists of a fixed size header, the binary fingerprints of the
+# parents, the request method, URL and response URL (separated by newlines), the
+# raw response headers and the (possibly compressed) body. Objects are stored
+# pickled as body. Deduplicated bodies are stored in a blob file and the record
+# only contains the hash of the body.
+_RECORD_MAGIC = b"FCR1"
+_RECORD_HEADER = struct.Struct("<4sBBHddHII")
+_RECORD_TYPES = ("response", "object")
+_FINGERPRINT_SIZE = 20
+# Codec id of records that reference a deduplicated body.
+_BLOB_REFERENCE = 0xFF
+_BLOBS_DIR = "_blobs"
+# Records and blobs are written to temporary files in this directory first.
+# Files that are left over, e.g. by killed processes, are removed by cleanup
+# once they are older than _TMP_EXPIRATION_SECS.
+_TMP_DIR = "_tmp"
+_TMP_EXPIRATION_SECS = 60 * 60
+
+_CacheRecord = namedtuple(
+    "_CacheRecord",
+    (
+        "type",
+        "status",
+        "timestamp",
+        "cache_expires",
+        "parents",
+        "method",
+        "url",
+        "response_url",
+        "headers",
+        "body",
+        "blob",
+    ),
+    defaults=(None,),
+)
+
+
+def _encode_record(record, codec=0):
+    if record.blob is not None:
+        codec, body = _BLOB_REFERENCE, bytes.fromhex(record.blob)
+    else:
+        codec, body = _compress(codec, record.body)
+    meta = "\n".join(
+        (record.method or "", record.url or "", record.response_url or "")
+    ).encode()
+    return b"".join(
+        [
+            _RECORD_HEADER.pack(
+                _RECORD_MAGIC,
+                _RECORD_TYPES.index(record.type),
+                codec,
+                record.status or 0,
+                record.timestamp,
+                math.nan if record.cache_expires is None else record.cache_expires,
+                len(record.parents),
+                len(meta),
+                len(record.headers),
+            ),
+            *(bytes.fromhex(parent) for parent in record.parents),
+            meta,
+            record.headers,
+            body,
+        ]
+    )
+
+
+# Errors raised by _decode_record() for records that are truncated or corrupt.
+_DECODE_ERRORS = (
+    struct.error,
+    ValueError,
+    IndexError,
+    EOFError,
+    gzip.BadGzipFile,
+    zlib.error,
+)
+if zstandard is not None:
+    _DECODE_ERRORS += (zstandard.ZstdError,)
+
+
+def _decode_record(data):
+    (
+        magic,
+        type_,
+        codec,
+        status,
+        timestamp,
+        cache_expires,
+        num_parents,
+        meta_len,
+        headers_len,
+    ) = _RECORD_HEADER.unpack_from(data)
+    if magic != _RECORD_MAGIC:
+        raise ValueError("Not a cache record")
+    offset = _RECORD_HEADER.size
+    parents = [
+        data[i : i + _FINGERPRINT_SIZE].hex()
+        for i in range(
+            offset, offset + num_parents * _FINGERPRINT_SIZE, _FINGERPRINT_SIZE
+        )
+    ]
+    offset += num_parents * _FINGERPRINT_SIZE
+    method, url, response_url = data[offset : offset + meta_len].decode().split("\n")
+    offset += meta_len
+    headers = data[offset : offset + headers_len]
+    body = data[offset + headers_len :]
+    if codec == _BLOB_REFERENCE:
+        # The body has to be read from the blob file.
+        blob, body = body.hex(), None
+    else:
+        blob, body = None, _decompress(codec, body)
+    return _CacheRecord(
+        type=_RECORD_TYPES[type_],
+        status=status or None,
+        timestamp=timestamp,
+        cache_expires=None if math.isnan(cache_expires) else cache_expires,
+        parents=parents,
+        method=method,
+        url=url,
+        response_url=response_url,
+        headers=headers,
+        body=body,
+        blob=blob,
+    )
+
+
+class _NegativeCache:
+    """Error responses that are used from the cache for a short time.
+
+    Responses with a status code in HTTPCACHE_IGNORE_HTTP_CODES are not used from
+    the cache, unless the status code is also in HTTPCACHE_NEGATIVE_HTTP_CODES and
+    the response is younger than HTTPCACHE_NEGATIVE_EXPIRATION_SECS. Requests for
+    e.g. dead links then don't have to be sent on every crawl.
+    """
+
+    def __init__(self, settings):
+        self.codes = {int(x) for x in settings.getlist("HTTPCACHE_NEGATIVE_HTTP_CODES")}
+        self.expiration_secs = settings.getint("HTTPCACHE_NEGATIVE_EXPIRATION_SECS")
+
+    def is_fresh(self, status, timestamp, now=None):
+        if status not in self.codes:
+            return False
+        return (now or time()) < timestamp + self.expiration_secs
+
+    def split(self, ignore_http_codes):
+        """Split ignored status codes into codes without and with negative cache."""
+        return (
+            [code for code in ignore_http_codes if code not in self.codes],
+            [code for code in ignore_http_codes if code in self.codes],
+        )
+
+
+def _remove_stale_file(path):
+    """Remove a left over temporary file and return the number of freed bytes.
+
+    Files that are younger than _TMP_EXPIRATION_SECS may still be written and
+    are kept.
+    """
+    try:
+        stat = os.stat(path)
+        if stat.st_mtime > time() - _TMP_EXPIRATION_SECS:
+            return 0
+        os.remove(path)
+    except FileNotFoundError:
+        return 0
+    return stat.st_size
+
+
+def _get_size(path):
+    """Return the size of a cache entry (a file or a legacy directory)."""
+    if os.path.isdir(path):
+        return sum(
+            os.path.getsize(os.path.join(dirpath, f))
+            for dirpath, _dirs, files in os.walk(path)
+            for f in files
+        )
+    return os.path.getsize(path)
+
+
+def _build_response(url, status, headers, body):
+    headers = Headers(headers_raw_to_dict(headers))
+    respcls = responsetypes.from_args(headers=headers, url=url, body=body)
+    return respcls(url=url, headers=headers, status=status, body=body)
 
 
 class FeedsCacheStorage(FilesystemCacheStorage):
+    """Cache storage that keeps every entry in a single file.
+
+    A cache hit only needs one open and one read. Entries written by older
+    versions (a directory per entry) can still be read and are replaced when
+    they are stored again.
+    """
+
     def __init__(self, settings):
         super().__init__(settings)
-        # gzip is not supported
+        # Bodies are compressed per entry (see HTTPCACHE_COMPRESSION) rather than
+        # gzipping whole files.
         self.use_gzip = False
         self._open = open
         self.ignore_http_codes = [
             int(x) for x in settings.getlist("HTTPCACHE_IGNORE_HTTP_CODES")
         ]
+        self.negative_cache = _NegativeCache(settings)
+        self.debug_meta = settings.getbool("HTTPCACHE_DEBUG_META")
+        self.codec = _get_codec(settings)
+        self.deduplicate = settings.getbool("HTTPCACHE_DEDUPLICATE")
+        self.deduplicate_min_size = settings.getint("HTTPCACHE_DEDUPLICATE_MIN_SIZE")
+        self.index = FeedsCacheIndex(os.path.join(self.cachedir, "index.sqlite"))
+        self.cleanup_threads = settings.getint("HTTPCACHE_CLEANUP_THREADS", 8)
+        self.settings = settings
+        self.quota = settings.getint("HTTPCACHE_QUOTA")
+        self._spider_quotas = {}
+
+    def close_spider(self, spider):
+        super().close_spider(spider)
+        FeedsCacheStats.for_spider(spider).close()
 
     def retrieve_response(self, spider, request):
         """Return response if present in cache, or None otherwise."""
-        metadata = self._read_meta(spider, request)
-        if metadata is not None and metadata["status"] in self.ignore_http_codes:
+        stats = FeedsCacheStats.for_spider(spider)
+        with stats.timed("retrieve_response"):
+            record = self._read_record(self._get_request_path(spider, request), stats)
+        if record is None:
+            stats.inc("miss")
+            return None
+        if record.status in self.ignore_http_codes and not (
+            self.negative_cache.is_fresh(record.status, record.timestamp)
+        ):
             # ignore cache entry for error responses
             logger.debug(f"Response for {request} not cached")
-            return
-        # Retrieve response from cache.
-        try:
-            return super().retrieve_response(spider, request)
-        finally:
-            logger.debug(f"Retrieved response for {request} from cache")
+            stats.inc("ignored")
+            return None
+        logger.debug(f"Retrieved response for {request} from cache")
+        stats.inc("hit")
+        if self.quota or self._get_spider_quota(spider.name):
+            # Entries are evicted in order of their last access.
+            self.index.touch(
+                spider.name,
+                cache_fingerprint(request, spider).hex(),
+                time(),
+            )
+        return _build_response(
+            record.response_url, record.status, record.headers, record.body
+        )
+
+    def _get_spider_quota(self, spider_name):
+        """Return the quota of a spider in bytes or 0 if it has none."""
+        if spider_name not in self._spider_quotas:
+            spider_key = spider_name.replace(".", "_").upper()
+            quota = self.settings.getint(f"FEEDS_SPIDER_{spider_key}_CACHE_QUOTA")
+            self._spider_quotas[spider_name] = quota * 1024 * 1024
+        return self._spider_quotas[spider_name]
 
     def store_response(self, spider, request, response):
         """Store the given response in the cache."""
-        # Read the old metadata.
-        old_metadata = self._read_meta(spider, request)
-        # This will overwrite old metadata (if there is one).
-        super().store_response(spider, request, response)
-        # Read the new metadata.
-        metadata = self._read_meta(spider, request)
-        # Add the parents' fingerprints to the metadata and merge the parents from the
-        # old metadata. The last fingerprint is not included since it's the fingerprint
-        # of this request.
-        metadata["parents"] = list(
-            set(request.meta["fingerprints"][:-1]).union(
-                old_metadata["parents"] if old_metadata else []
-            )
-        )
-        if request.meta.get("cache_expires") is not None:
-            metadata["cache_expires"] = request.meta["cache_expires"].total_seconds()
-        metadata["type"] = "response"
-        # Write it back.
-        rpath = self._get_request_path(spider, request)
-        self._write_meta_to_path(rpath, metadata)
+        path = self._get_request_path(spider, request)
+        key = os.path.basename(path)
+        cache_expires = request.meta.get("cache_expires")
+        if cache_expires is not None:
+            cache_expires = cache_expires.total_seconds()
+        # Add the parents' fingerprints to the index which keeps the parents of
+        # older entries.
+        self.index.add_parents(spider.name, key, _parent_fingerprints(request))
+        blob = None
+        blob_size = 0
+        if self.deduplicate and len(response.body) >= self.deduplicate_min_size:
+            blob, blob_size = self._store_blob(response.body)
+        record = _CacheRecord(
+            type="response",
+            status=response.status,
+            timestamp=time(),
+            cache_expires=cache_expires,
+            parents=self.index.parents(spider.name, key),
+            method=request.method,
+            url=request.url,
+            response_url=response.url,
+            headers=headers_dict_to_raw(response.headers),
+            body=response.body,
+            blob=blob,
+        )
+        stats = FeedsCacheStats.for_spider(spider)
+        with stats.timed("store_response"):
+            size = self._write_record(path, record)
+            self.index.add(
+                spider.name,
+                key,
+                record.timestamp,
+                record.cache_expires,
+                record.status,
+                record.blob,
+                # Blobs are charged to every entry that references them.
+                size + blob_size,
+            )
+        stats.inc("store")
+        stats.inc("bytes_written", size)
 
     def _get_request_path(self, spider, request):
-        key = fingerprint(request, include_headers=["Cookie"]).hex()
-        return os.path.join(self.cachedir, spider.name, key[0:2], key)
+        key = cache_fingerprint(request, spider).hex()
+        return self._get_entry_path(spider.name, key)
 
     def retrieve_object(self, spider, key):
-        metadata = self._read_meta(spider, key)
-        if metadata is None:
+        record = self._read_record(self._get_key_path(spider, key))
+        if record is None:
             return None
-        path = self._get_key_path(spider, key)
-        with self._open(os.path.join(path, "object"), "rb") as f:
-            return pickle.load(f)
+        return pickle.loads(record.body)
 
     def store_object(self, spider, key, obj):
         path = self._get_key_path(spider, key)
-        if not os.path.exists(path):
-            os.makedirs(path)
-        metadata = {"timestamp": time(), "type": "object"}
-        self._write_meta_to_path(path, metadata)
-        with self._open(os.path.join(path, "object"), "wb") as f:
-            pickle.dump(obj, f, protocol=2)
+        record = _CacheRecord(
+            type="object",
+            status=None,
+            timestamp=time(),
+            cache_expires=None,
+            parents=[],
+            method=None,
+            url=None,
+            response_url=None,
+            headers=b"",
+            body=pickle.dumps(obj, protocol=2),
+        )
+        size = self._write_record(path, record)
+        self.index.add(spider.name, os.path.basename(path), record.timestamp, size=size)
 
     def _get_key_path(self, spider, key):
         key = hashlib.sha1(to_bytes(key)).hexdigest()
-        return os.path.join(self.cachedir, spider.name, key[0:2], key)
+        return self._get_entry_path(spider.name, key)
+
+    def _get_entry_path(self, spider_name, key):
+        return os.path.join(self.cachedir, spider_name, key[0:2], key)
 
     def remove_response(self, response, spider):
-        self.remove_cache_entry(
-            self._get_request_path(spider, response.request), remove_parents=True
+        self.remove_responses([response], spider)
+
+    def remove_responses(self, responses, spider):
+        self.remove_fingerprints(
+            [cache_fingerprint(r.request, spider) for r in responses], spider
         )
 
-    def _read_meta(self, spider, key):
-        if isinstance(key, scrapy.Request):
-            path = self._get_request_path(spider, key)
-        else:
-            path = self._get_key_path(spider, key)
-        return self._read_meta_from_path(path)
+    def remove_fingerprints(self, fingerprints, spider):
+        """Remove the entries of request fingerprints and their parents.
+
+        Entries shared by several requests (usually the parents) are only
+        removed once.
+        """
+        keys = {fpr.hex() for fpr in fingerprints}
+        stats = FeedsCacheStats.for_spider(spider)
+        with stats.timed("remove_response"):
+            entries = set(keys)
+            cascaded = 0
+            for key in keys:
+                parents = self._parents(spider.name, key)
+                cascaded += len(parents)
+                entries.update(parents)
+            removed = sum(self._remove_entry(spider.name, key) for key in entries)
+        stats.inc("remove_response", len(fingerprints))
+        # Entries removed including parents.
+        stats.inc("removed", removed)
+        stats.inc("removals_collapsed", len(fingerprints) + cascaded - len(entries))
 
-    def _read_meta_from_path(self, path):
+    def close(self):
+        self.index.close()
+
+    def _read_record(self, path, stats=_NO_CACHE_STATS):
         try:
-            with open(os.path.join(path, "pickled_meta"), "rb") as f:
-                return pickle.load(f)
+            with open(path, "rb") as f:
+                data = f.read()
         except FileNotFoundError:
             return None
+        except IsADirectoryError:
+            return self._read_legacy_record(path)
+        stats.inc("bytes_read", len(data))
+        try:
+            record = _decode_record(data)
+        except _DECODE_ERRORS as e:
+            # The entry is treated as missing; its index entry expires as usual.
+            logger.warning(f"Removing corrupt cache entry {path}: {e!r}")
+            self._remove_path(path)
+            self._remove_path(f"{path}.meta")
+            return None
+        if record.blob is not None:
+            try:
+                record = record._replace(body=self._read_blob(record.blob, stats))
+            except FileNotFoundError:
+                return None
+        return record
+
+    def _get_blob_path(self, blob):
+        return os.path.join(self.cachedir, _BLOBS_DIR, blob[0:2], blob)
+
+    def _read_blob(self, blob, stats=_NO_CACHE_STATS):
+        with open(self._get_blob_path(blob), "rb") as f:
+            data = f.read()
+        stats.inc("bytes_read", len(data))
+        return _decompress(data[0], memoryview(data)[1:])
+
+    def _store_blob(self, body):
+        """Store body in the blob store unless it is already there.
+
+        Returns the name and the size of the blob.
+        """
+        blob = hashlib.sha256(body).hexdigest()
+        path = self._get_blob_path(blob)
+        try:
+            return blob, os.path.getsize(path)
+        except FileNotFoundError:
+            pass
+        codec, data = _compress(self.codec, body)
+        # Write to a temporary file first so that concurrent readers never see
+        # a partial blob.
+        self._write_atomically(path, bytes([codec]) + data)
+        return blob, len(data) + 1
 
-    def _write_meta_to_path(self, path, metadata):
-        with self._open(os.path.join(path, "meta"), "wb") as f:
-            f.write(to_bytes(repr(metadata)))
-        with self._open(os.path.join(path, "pickled_meta"), "wb") as f:
-            pickle.dump(metadata, f, protocol=2)
+    def _read_legacy_record(self, path):
+        """Read an entry that was stored as a directory by older versions."""
 
-    def cleanup(self):
+        def _read(name):
+            with open(os.path.join(path, name), "rb") as f:
+                return f.read()
+
+        try:
+            meta = pickle.loads(_read("pickled_meta"))
+        except FileNotFoundError:
+            return None
+        type_ = meta.get("type", "response")
+        return _CacheRecord(
+            type=type_,
+            status=meta.get("status"),
+            timestamp=meta["timestamp"],
+            cache_expires=meta.get("cache_expires"),
+            # Older entries store parent fingerprints as bytes.
+            parents=[
+                fpr.hex() if isinstance(fpr, bytes) else fpr
+                for fpr in meta.get("parents", [])
+            ],
+            method=meta.get("method"),
+            url=meta.get("url"),
+            response_url=meta.get("response_url"),
+            headers=_read("response_headers") if type_ == "response" else b"",
+            body=_read("response_body" if type_ == "response" else "object"),
+        )
+
+    def _write_record(self, path, record):
+        """Write a record and return its size."""
+        data = _encode_record(record, self.codec)
+        # Write to a temporary file first so that readers never see a partial
+        # record.
+        self._write_atomically(path, data)
+        if self.debug_meta:
+            metadata = record._asdict()
+            del metadata["headers"], metadata["body"]
+            with open(f"{path}.meta", "wb") as f:
+                f.write(to_bytes(repr(metadata)))
+        return len(data)
+
+    def _write_atomically(self, path, data):
+        """Write data to a temporary file and rename it to path."""
+        tmp_path = os.path.join(
+            self.cachedir,
+            _TMP_DIR,
+            f"{os.getpid()}-{threading.get_ident()}-{os.path.basename(path)}",
+        )
+        try:
+            f = open(tmp_path, "wb")
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
+            f = open(tmp_path, "wb")
+        try:
+            with f:
+                f.write(data)
+            try:
+                os.replace(tmp_path, path)
+            except FileNotFoundError:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+            except IsADirectoryError:
+                # Replace entry stored by older versions.
+                shutil.rmtree(path, ignore_errors=True)
+                os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def iter_entries(self):
+        """Yield spider name, key and record of all entries in the cache."""
+        for spider_name, bucket_path in self._iter_buckets():
+            for key, record in self._read_bucket(bucket_path):
+                yield spider_name, key, record
+
+    def _iter_buckets(self):
+        """Yield spider name and path of all bucket directories in the cache."""
+        for spider_name in sorted(os.listdir(self.cachedir)):
+            spider_root = os.path.join(self.cachedir, spider_name)
+            if spider_name in (_BLOBS_DIR, _TMP_DIR) or not os.path.isdir(spider_root):
+                continue
+            for bucket in sorted(os.listdir(spider_root)):
+                bucket_path = os.path.join(spider_root, bucket)
+                if len(bucket) == 2 and os.path.isdir(bucket_path):
+                    yield spider_name, bucket_path
+
+    def _read_bucket(self, bucket_path):
+        for key in sorted(os.listdir(bucket_path)):
+            if key.endswith(".tmp"):
+                # Written next to the entries by older versions.
+                _remove_stale_file(os.path.join(bucket_path, key))
+                continue
+            if key.endswith(".meta"):
+                continue
+            record = self._read_record(os.path.join(bucket_path, key))
+            if record is not None:
+                yield key, record
+
+    def cleanup(self, spiders=None):
         """Removes cache entries in path.
 
         Entries are removed if one of the conditions is true:
           - Response has a certain status code (e.g. 404).
           - Individual expiration date is reached (compared to now).
           - Timestamp of entry and expires exceeds now.
+
+        Due entries are looked up in the index so only they are visited. If
+        spiders is given, only entries of these spiders are removed. Files are
+        read and removed by a thread pool, one bucket directory per task.
         """
 
         logger.debug(f"Cleaning cache entries from {self.cachedir} ...")
 
+        stats = CleanupStats()
+        with ThreadPoolExecutor(self.cleanup_threads) as executor:
+            if not self.index.built:
+                self._build_index(executor, stats)
+
+            now = int(datetime.now(timezone.utc).timestamp())
+            due = set(self.index.expired(now, self.expiration_secs, spiders))
+            ignored, negative = self.negative_cache.split(self.ignore_http_codes)
+            errors = self.index.with_status(ignored, spiders)
+            errors += self.index.with_status(
+                negative, spiders, now - self.negative_cache.expiration_secs
+            )
+            for spider_name, key in errors:
+                due.add((spider_name, key))
+                due.update(
+                    (spider_name, fpr) for fpr in self.index.parents(spider_name, key)
+                )
+            stats.scanned += len(due)
+            self.index.remove_many(due)
+            evicted = self._over_quota(spiders)
+            self.index.remove_many(evicted)
+            due.update(evicted)
+
+            buckets = defaultdict(list)
+            for spider_name, key in due:
+                path = self._get_entry_path(spider_name, key)
+                buckets[os.path.dirname(path)].append(path)
+            for blob in self.index.unreferenced_blobs():
+                if self.index.remove_blob(blob):
+                    path = self._get_blob_path(blob)
+                    buckets[os.path.dirname(path)].append(path)
+            for removed, bytes_freed in executor.map(
+                self._remove_paths, buckets.values()
+            ):
+                stats.removed += removed
+                stats.bytes_freed += bytes_freed
+
+        tmp_root = os.path.join(self.cachedir, _TMP_DIR)
+        if os.path.isdir(tmp_root):
+            for name in os.listdir(tmp_root):
+                stats.bytes_freed += _remove_stale_file(os.path.join(tmp_root, name))
+
+        logger.debug("Finished cleaning cache entries.")
+        return stats
+
+    def _over_quota(self, spiders=None):
+        """Return the least recently used entries that exceed the quotas.
+
+        Quotas of spiders are only checked for the given spiders, the global
+        quota is always checked.
+        """
+        if not self._has_quota(spiders):
+            return set()
+        sizes = self.index.sizes()
+        evicted = set()
+
+        def evict(excess, spider_name=None):
+            for entry_spider, key, size in self.index.least_recently_used(spider_name):
+                if excess <= 0:
+                    break
+                if (entry_spider, key) not in evicted:
+                    evicted.add((entry_spider, key))
+                    sizes[entry_spider] -= size
+                    excess -= size
+
+        for spider_name, size in list(sizes.items()):
+            if spiders is not None and spider_name not in spiders:
+                continue
+            quota = self._get_spider_quota(spider_name)
+            if quota and size > quota:
+                logger.info(f"Cache of spider {spider_name} exceeds its quota")
+                evict(size - quota, spider_name)
+        total = sum(sizes.values())
+        if self.quota and total > self.quota:
+            logger.info("Cache exceeds its quota")
+            evict(total - self.quota)
+        return evicted
+
+    def _has_quota(self, spiders=None):
+        """Return True if the global quota or a quota of a spider is set."""
+        if self.quota:
+            return True
+        if spiders is not None:
+            return any(self._get_spider_quota(spider) for spider in spiders)
+        return any(
+            name.startswith("FEEDS_SPIDER_")
+            and name.endswith("_CACHE_QUOTA")
+            and self.settings.getint(name)
+            for name in self.settings
+        )
+
+    def _build_index(self, executor, stats):
+        """Add all entries of the cache to the index.
+
+        This is only necessary once for caches that were created before the index
+        existed.
+        """
+        logger.info(f"Building cache index for {self.cachedir} ...")
+
+        # Blobs that are not referenced by any entry are removed by cleanup.
+        blobs = {}
+        blobs_root = os.path.join(self.cachedir, _BLOBS_DIR)
+        for dirpath, _dirs, files in os.walk(blobs_root):
+            for blob in files:
+                if blob.endswith(".tmp"):
+                    # Written next to the blobs by older versions.
+                    _remove_stale_file(os.path.join(dirpath, blob))
+                else:
+                    blobs[blob] = os.path.getsize(os.path.join(dirpath, blob))
+
+        def read_bucket(bucket):
+            spider_name, bucket_path = bucket
+            # Bodies are not needed for the index, so don't keep them around.
+            return spider_name, [
+                (
+                    key,
+                    record._replace(body=None),
+                    _get_size(os.path.join(bucket_path, key)),
+                )
+                for key, record in self._read_bucket(bucket_path)
+            ]
+
+        def entries():
+            for spider_name, entries in executor.map(read_bucket, self._iter_buckets()):
+                for key, record, size in entries:
+                    yield (
+                        spider_name,
+                        key,
+                        record.timestamp,
+                        record.cache_expires,
+                        record.status,
+                        record.blob,
+                        # Blobs are charged to every entry that references them.
+                        size + blobs.get(record.blob, 0),
+                        record.parents,
+                    )
+                stats.scanned += len(entries)
+
+        self.index.rebuild(entries(), blobs.keys())
+
+    def _parents(self, spider_name, key):
+        """Return the fingerprints of the parents of an entry.
+
+        The parents of entries stored before the index was built are only
+        kept in the entries themselves.
+        """
+        parents = self.index.parents(spider_name, key)
+        if not parents and not self.index.built:
+            record = self._read_record(self._get_entry_path(spider_name, key))
+            if record is not None:
+                parents = record.parents
+        return parents
+
+    def _remove_entry(self, spider_name, key, remove_parents=False):
+        """Remove an entry and return the number of removed entries."""
+        path = self._get_entry_path(spider_name, key)
+        removed = 0
+        if remove_parents:
+            for fpr in self._parents(spider_name, key):
+                removed += self._remove_entry(spider_name, fpr)
+
+        if self._remove_path(path):
+            removed += 1
+        try:
+            os.remove(f"{path}.meta")
+        except FileNotFoundError:
+            pass
+        self.index.remove(spider_name, key)
+        return removed
+
+    def _remove_paths(self, paths):
+        """Remove entries or blobs in the same directory.
+
+        Returns the number of removed entries and the number of freed bytes.
+        """
+        removed = bytes_freed = 0
+        for path in paths:
+            size = self._remove_path(path) + self._remove_path(f"{path}.meta")
+            if size:
+                removed += 1
+                bytes_freed += size
+        return removed, bytes_freed
+
+    def _remove_path(self, path):
+        """Remove an entry and return the number of freed bytes."""
+        try:
+            size = _get_size(path)
+            os.remove(path)
+        except IsADirectoryError:
+            shutil.rmtree(path, ignore_errors=True)
+        except FileNotFoundError:
+            return 0
+        # Try to delete parent directory of cache entry.
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            # Not empty, don't care.
+            pass
+        return size
+
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    spider TEXT NOT NULL,
+    key TEXT NOT NULL,
+    type TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    cache_expires REAL,
+    status INTEGER,
+    method TEXT,
+    url TEXT,
+    response_url TEXT,
+    headers BLOB,
+    body BLOB,
+    codec INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (spider, key)
+);
+CREATE INDEX IF NOT EXISTS entries_timestamp ON entries (timestamp);
+CREATE INDEX IF NOT EXISTS entries_expires ON entries (timestamp + cache_expires);
+CREATE INDEX IF NOT EXISTS entries_status ON entries (status);
+CREATE TABLE IF NOT EXISTS parents (
+    spider TEXT NOT NULL,
+    key TEXT NOT NULL,
+    parent TEXT NOT NULL,
+    PRIMARY KEY (spider, key, parent)
+);
+-- Created by older versions, parents are only looked up by child.
+DROP INDEX IF EXISTS parents_parent;
+"""
+
+
+class FeedsSqliteCacheStorage:
+    """Cache storage that keeps all entries in a single SQLite database.
+
+    Entries are keyed by spider name and fingerprint (or the SHA1 of the key for
+    objects) which makes a lookup a single indexed query instead of several file
+    system operations. Response metadata is kept in columns so that cleanup can
+    be done with plain SQL.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.cachedir = data_path(settings["HTTPCACHE_DIR"])
+        self.expiration_secs = settings.getint("HTTPCACHE_EXPIRATION_SECS")
+        self.ignore_http_codes = [
+            int(x) for x in settings.getlist("HTTPCACHE_IGNORE_HTTP_CODES")
+        ]
+        self.negative_cache = _NegativeCache(settings)
+        self.codec = _get_codec(settings)
+        self.db_path = os.path.join(self.cachedir, "cache.sqlite")
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            os.makedirs(self.cachedir, exist_ok=True)
+            # Autocommit mode, transactions are started explicitly where needed.
+            self._db = sqlite3.connect(self.db_path, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._migrate()
+        return self._db
+
+    def _migrate(self):
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(entries)")]
+        if columns and "codec" not in columns:
+            # Databases created before compression was supported.
+            self._db.execute(
+                "ALTER TABLE entries ADD COLUMN codec INTEGER NOT NULL DEFAULT 0"
+            )
+        self._db.executescript(_SQLITE_SCHEMA)
+
+    def open_spider(self, spider):
+        logger.debug(f"Using SQLite cache storage in {self.db_path}")
+
+    def close_spider(self, spider):
+        pass
+
+    def retrieve_response(self, spider, request):
+        """Return response if present in cache, or None otherwise."""
+        row = self.db.execute(
+            "SELECT status, response_url, headers, body, codec, timestamp "
+            "FROM entries WHERE spider = ? AND key = ? AND type = 'response'",
+            (spider.name, self._get_request_key(spider, request)),
+        ).fetchone()
+        if row is None:
+            return None
+        status, url, headers, body, codec, timestamp = row
+        if status in self.ignore_http_codes and not (
+            self.negative_cache.is_fresh(status, timestamp)
+        ):
+            # ignore cache entry for error responses
+            logger.debug(f"Response for {request} not cached")
+            return None
+        logger.debug(f"Retrieved response for {request} from cache")
+        return _build_response(url, status, headers, _decompress(codec, body))
+
+    def store_response(self, spider, request, response):
+        """Store the given response in the cache."""
+        key = self._get_request_key(spider, request)
+        cache_expires = request.meta.get("cache_expires")
+        if cache_expires is not None:
+            cache_expires = cache_expires.total_seconds()
+        record = _CacheRecord(
+            type="response",
+            status=response.status,
+            timestamp=time(),
+            cache_expires=cache_expires,
+            parents=_parent_fingerprints(request),
+            method=request.method,
+            url=request.url,
+            response_url=response.url,
+            headers=headers_dict_to_raw(response.headers),
+            body=response.body,
+        )
+        with self.db:
+            self.db.execute("BEGIN")
+            # Parents of older entries are kept.
+            self._insert_entry(spider.name, key, record)
+
+    def retrieve_object(self, spider, key):
+        row = self.db.execute(
+            "SELECT body, codec FROM entries "
+            "WHERE spider = ? AND key = ? AND type = 'object'",
+            (spider.name, self._get_object_key(key)),
+        ).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(_decompress(row[1], row[0]))
+
+    def store_object(self, spider, key, obj):
+        record = _CacheRecord(
+            type="object",
+            status=None,
+            timestamp=time(),
+            cache_expires=None,
+            parents=[],
+            method=None,
+            url=None,
+            response_url=None,
+            headers=None,
+            body=pickle.dumps(obj),
+        )
+        self._insert_entry(spider.name, self._get_object_key(key), record)
+
+    def remove_response(self, response, spider):
+        self.remove_responses([response], spider)
+
+    def remove_responses(self, responses, spider):
+        self.remove_fingerprints(
+            [cache_fingerprint(r.request, spider) for r in responses], spider
+        )
+
+    def remove_fingerprints(self, fingerprints, spider):
+        """Remove the entries of request fingerprints and their parents in one
+        transaction."""
+        keys = [fpr.hex() for fpr in fingerprints]
+        stats = FeedsCacheStats.for_spider(spider)
+        with stats.timed("remove_response"), self.db:
+            self.db.execute("BEGIN")
+            collapsed = self._remove_entries(spider.name, keys, remove_parents=True)
+        stats.inc("remove_response", len(fingerprints))
+        stats.inc("removals_collapsed", collapsed)
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def cleanup(self, spiders=None):
+        """Removes cache entries.
+
+        Entries are removed if one of the conditions is true:
+          - Response has a certain status code (e.g. 404).
+          - Individual expiration date is reached (compared to now).
+          - Timestamp of entry and expires exceeds now.
+
+        If spiders is given, only entries of these spiders are removed.
+        """
+        logger.debug(f"Cleaning cache entries from {self.db_path} ...")
+
         now = int(datetime.now(timezone.utc).timestamp())
-        for cache_entry_path, _dirs, files in os.walk(self.cachedir, topdown=False):
-            if "pickled_meta" in files:
-                meta = self._read_meta_from_path(cache_entry_path)
-                entry_expires_after = min(
-                    meta.get("cache_expires", self.expiration_secs),
-                    self.expiration_secs,
+        spider_clause, spider_params = _spider_clause(spiders)
+        free_pages = self._pragma("freelist_count")
+        with self.db:
+            self.db.execute("BEGIN")
+            entries = self._count_entries()
+            # Both conditions are answered from an index, so only due entries are
+            # visited.
+            self.db.execute(
+                f"DELETE FROM entries WHERE timestamp < ?{spider_clause}",
+                [now - self.expiration_secs, *spider_params],
+            )
+            self.db.execute(
+                "DELETE FROM entries "
+                f"WHERE timestamp + cache_expires < ?{spider_clause}",
+                [now, *spider_params],
+            )
+            if self.ignore_http_codes:
+                # Responses in the negative cache are kept until they expire.
+                _, negative = self.negative_cache.split(self.ignore_http_codes)
+                rows = self.db.execute(
+                    "SELECT spider, key FROM entries "
+                    "WHERE type = 'response' AND status IN ({}) "
+                    "AND NOT (status IN ({}) AND timestamp >= ?){}".format(
+                        ", ".join("?" * len(self.ignore_http_codes)),
+                        ", ".join("?" * len(negative)),
+                        spider_clause,
+                    ),
+                    [
+                        *self.ignore_http_codes,
+                        *negative,
+                        now - self.negative_cache.expiration_secs,
+                        *spider_params,
+                    ],
+                ).fetchall()
+                for spider_name, key in rows:
+                    self._remove_entries(spider_name, [key], remove_parents=True)
+            self.db.execute(
+                "DELETE FROM parents WHERE NOT EXISTS (SELECT 1 FROM entries "
+                "WHERE entries.spider = parents.spider AND entries.key = parents.key)"
+            )
+            removed = entries - self._count_entries()
+        self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+        logger.debug("Finished cleaning cache entries.")
+        # Freed pages are reused by the database, the file does not shrink.
+        return CleanupStats(
+            scanned=removed,
+            removed=removed,
+            bytes_freed=(self._pragma("freelist_count") - free_pages)
+            * self._pragma("page_size"),
+        )
+
+    def _pragma(self, name):
+        return self.db.execute(f"PRAGMA {name}").fetchone()[0]
+
+    def _count_entries(self):
+        return self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def import_filesystem_cache(self, remove=False):
+        """Import entries of a FeedsCacheStorage in the same cache dir.
+
+        Returns the number of imported entries. If remove is True, imported
+        entries are removed from the file system.
+        """
+        logger.info(f"Importing cache entries from {self.cachedir} ...")
+
+        fs_storage = FeedsCacheStorage(self.settings)
+        imported = 0
+        for spider_name, key, record in fs_storage.iter_entries():
+            with self.db:
+                self.db.execute("BEGIN")
+                self._insert_entry(spider_name, key, record)
+            if remove:
+                fs_storage._remove_entry(spider_name, key)
+            imported += 1
+
+        logger.info(f"Imported {imported} cache entries.")
+        return imported
+
+    def _insert_entry(self, spider_name, key, record):
+        codec, body = _compress(self.codec, record.body)
+        self.db.execute(
+            "INSERT OR REPLACE INTO entries (spider, key, type, timestamp, "
+            "cache_expires, status, method, url, response_url, headers, body, codec) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                spider_name,
+                key,
+                record.type,
+                record.timestamp,
+                record.cache_expires,
+                record.status,
+                record.method,
+                record.url,
+                record.response_url,
+                record.headers,
+                body,
+                codec,
+            ),
+        )
+        self.db.executemany(
+            "INSERT OR IGNORE INTO parents VALUES (?, ?, ?)",
+            ((spider_name, key, parent) for parent in record.parents),
+        )
+
+    def _remove_entries(self, spider_name, keys, remove_parents=False):
+        """Remove entries and return the number of removals that were collapsed."""
+        # Entries are only removed once, even if they are the parent of several.
+        requested = len(keys)
+        keys = dict.fromkeys(keys)
+        if remove_parents:
+            for key in list(keys):
+                parents = [
+                    row[0]
+                    for row in self.db.execute(
+                        "SELECT parent FROM parents WHERE spider = ? AND key = ?",
+                        (spider_name, key),
+                    )
+                ]
+                requested += len(parents)
+                keys.update(dict.fromkeys(parents))
+        for key in keys:
+            self.db.execute(
+                "DELETE FROM entries WHERE spider = ? AND key = ?", (spider_name, key)
+            )
+            self.db.execute(
+                "DELETE FROM parents WHERE spider = ? AND key = ?", (spider_name, key)
+            )
+        return requested - len(keys)
+
+    def _get_request_key(self, spider, request):
+        return cache_fingerprint(request, spider).hex()
+
+    def _get_object_key(self, key):
+        return hashlib.sha1(to_bytes(key)).hexdigest()
+
+
+# A pack segment is a sequence of frames: the binary key, flags and the length of
+# the cache record that follows. Tombstone frames have no record.
+_PACK_FRAME = struct.Struct("<20sBI")
+_PACK_TOMBSTONE = 1
+_PACK_SEGMENT_SIZE = 64 * 1024 * 1024
+# Compact if more than this fraction of the segments is garbage.
+_PACK_COMPACT_RATIO = 0.5
+
+
+class _Pack:
+    """Append-only segment files of a spider with an in-memory index.
+
+    The index maps keys to segment, offset and length of the latest record as
+    well as timestamp, cache_expires and status of the entry. It is saved to a
+    small index file and restored at startup; only the parts of segments which
+    were written after the index was saved have to be scanned. All methods are
+    thread-safe so that compaction can run in the background.
+
+    Several processes may use a pack at the same time (e.g. a crawl and a
+    cleanup). Writes are serialized with a lock file and every process applies
+    the frames appended by other processes before it writes. Records written by
+    other processes are only found after that.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.entries = {}
+        self._sizes = {}
+        self._mmaps = {}
+        self._file = None
+        self._active = None
+        self._lock_depth = 0
+        self._compacting = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._lock_file = open(os.path.join(path, "lock"), "ab")
+        with self.locked():
+            pass
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, f"{segment:08d}.seg")
+
+    def _list_segments(self):
+        return sorted(
+            int(name[:-4]) for name in os.listdir(self.path) if name.endswith(".seg")
+        )
+
+    @contextmanager
+    def locked(self):
+        """Lock the pack, also against other processes, and catch up with them."""
+        with self.lock:
+            if self._lock_depth == 0 and fcntl is not None:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                if self._lock_depth == 1:
+                    self._refresh()
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0 and fcntl is not None:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _refresh(self):
+        """Apply frames that were appended by other processes."""
+        segments = self._list_segments()
+        if self._active is None or not set(self._sizes) <= set(segments):
+            # Segments were removed by a compaction of another process.
+            self._reload()
+            return
+        for segment in segments:
+            # Only the last segment is written, older ones are not changed.
+            if segment >= self._active:
+                self._scan(segment, self._sizes.get(segment, 0))
+        if segments[-1] != self._active:
+            self._file.close()
+            self._open_segment(segments[-1])
+
+    def _reload(self):
+        if self._file is not None:
+            self._file.close()
+        # Maps that are still in use are closed once they are not referenced
+        # anymore.
+        self._mmaps = {}
+        self._load()
+        self._open_segment(max(self._sizes, default=1))
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.path, "index"), "rb") as f:
+                index = pickle.load(f)
+        except FileNotFoundError:
+            index = {"segments": {}, "entries": {}}
+        self.entries = index["entries"]
+        self._sizes = {}
+        last_indexed = max(index["segments"], default=0)
+        for segment in self._list_segments():
+            if segment < last_indexed and segment not in index["segments"]:
+                # Left over by an interrupted compaction, records have been copied.
+                os.remove(self._segment_path(segment))
+                continue
+            self._scan(segment, index["segments"].get(segment, 0))
+        for key, location in list(self.entries.items()):
+            if location[0] not in self._sizes:
+                del self.entries[key]
+
+    def _scan(self, segment, offset):
+        """Apply frames of a segment that are not covered by the index yet."""
+        path = self._segment_path(segment)
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        end = offset
+        for key, flags, data_offset, length in self._frames(data, offset):
+            if flags & _PACK_TOMBSTONE:
+                self.entries.pop(key, None)
+            else:
+                record = data[data_offset - offset : data_offset - offset + length]
+                self.entries[key] = (segment, data_offset, length) + _record_info(
+                    record
                 )
-                threshold = meta["timestamp"] + entry_expires_after
-                if now > threshold:
-                    self.remove_cache_entry(cache_entry_path)
-                elif (
-                    meta.get("type", "response") == "response"
-                    and meta["status"] in self.ignore_http_codes
+            end = data_offset + length
+        if end < offset + len(data):
+            # Cut off an incomplete frame, e.g. after a crash, so that the next
+            # frame is not read as part of it.
+            os.truncate(path, end)
+        self._sizes[segment] = end
+
+    def _frames(self, data, base_offset=0):
+        pos = 0
+        while pos + _PACK_FRAME.size <= len(data):
+            key, flags, length = _PACK_FRAME.unpack_from(data, pos)
+            pos += _PACK_FRAME.size
+            if pos + length > len(data):
+                # Incomplete frame at the end of the segment, e.g. after a crash.
+                break
+            yield key, flags, base_offset + pos, length
+            pos += length
+
+    def _open_segment(self, segment):
+        self._active = segment
+        self._file = open(self._segment_path(segment), "ab")
+        self._sizes[segment] = self._file.tell()
+
+    def _mmap(self, segment, size):
+        """Return a map of a segment that covers at least size bytes."""
+        # A map that is too small is closed, which must not happen while
+        # another thread reads from it.
+        with self.lock:
+            mm = self._mmaps.get(segment)
+            if mm is None or len(mm) < size:
+                if mm is not None:
+                    mm.close()
+                with open(self._segment_path(segment), "rb") as f:
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._mmaps[segment] = mm
+            return mm
+
+    def read(self, key):
+        with self.lock:
+            try:
+                return self._read(key)
+            except FileNotFoundError:
+                # The segment was removed by a compaction of another process.
+                with self.locked():
+                    return self._read(key)
+
+    def _read(self, key):
+        location = self.entries.get(key)
+        if location is None:
+            return None
+        segment, offset, length = location[:3]
+        return self._mmap(segment, offset + length)[offset : offset + length]
+
+    def append(self, key, record):
+        with self.locked():
+            offset = self._write(_PACK_FRAME.pack(key, 0, len(record)) + record)
+            self.entries[key] = (
+                self._active,
+                offset + _PACK_FRAME.size,
+                len(record),
+            ) + _record_info(record)
+
+    def remove(self, key):
+        """Remove a record and return True if it existed."""
+        with self.locked():
+            if self.entries.pop(key, None) is None:
+                return False
+            self._write(_PACK_FRAME.pack(key, _PACK_TOMBSTONE, 0))
+            return True
+
+    @property
+    def size(self):
+        """Size of all segments in bytes."""
+        with self.lock:
+            return sum(self._sizes.values())
+
+    def _write(self, frame):
+        if self._sizes[self._active] >= _PACK_SEGMENT_SIZE:
+            self._file.close()
+            self._open_segment(self._active + 1)
+        # Other processes may have appended to the segment.
+        offset = self._file.seek(0, os.SEEK_END)
+        self._file.write(frame)
+        # Flush so that the record can be read via mmap.
+        self._file.flush()
+        self._sizes[self._active] = offset + len(frame)
+        return offset
+
+    @property
+    def garbage_ratio(self):
+        """Return the fraction of the segments that is not used by live records."""
+        with self.lock:
+            total = self.size
+            live = sum(_PACK_FRAME.size + entry[2] for entry in self.entries.values())
+        return 1 - live / total if total else 0
+
+    def save_index(self):
+        with self.locked():
+            index = {"segments": dict(self._sizes), "entries": dict(self.entries)}
+            path = os.path.join(self.path, "index")
+            with open(f"{path}.tmp", "wb") as f:
+                pickle.dump(index, f, protocol=4)
+            os.replace(f"{path}.tmp", path)
+
+    def compact(self):
+        """Rewrite live records into a new segment and delete the old segments.
+
+        Writes may happen concurrently, they go to the new segment. Only one
+        process compacts a pack at a time.
+        """
+        if not self._compacting.acquire(blocking=False):
+            # Already running.
+            return
+        try:
+            with open(os.path.join(self.path, "compact.lock"), "ab") as lock_file:
+                if fcntl is not None:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        # Compacted by another process.
+                        return
+                self._compact()
+        finally:
+            self._compacting.release()
+
+    def _compact(self):
+        with self.locked():
+            self._file.close()
+            old_segments = sorted(self._sizes)
+            self._open_segment(self._active + 1)
+        for segment in old_segments:
+            # Old segments are not written anymore, so the map covers the
+            # whole segment and is not replaced by concurrent reads.
+            with self.lock:
+                size = self._sizes[segment]
+            if not size:
+                continue
+            mm = self._mmap(segment, size)
+            frames = [
+                frame for frame in self._frames(mm) if not frame[1] & _PACK_TOMBSTONE
+            ]
+            # Other processes are only blocked for a batch of records.
+            for i in range(0, len(frames), 1000):
+                with self.locked():
+                    for key, _, offset, length in frames[i : i + 1000]:
+                        location = self.entries.get(key)
+                        if location is not None and location[:3] == (
+                            segment,
+                            offset,
+                            length,
+                        ):
+                            self.append(key, mm[offset : offset + length])
+        with self.locked():
+            for segment in old_segments:
+                del self._sizes[segment]
+            # Save the index before removing the old segments so that no
+            # records are lost if this is interrupted.
+            self.save_index()
+            for segment in old_segments:
+                mm = self._mmaps.pop(segment, None)
+                if mm is not None:
+                    mm.close()
+                os.remove(self._segment_path(segment))
+
+    def close(self):
+        with self.locked():
+            self._file.flush()
+            self.save_index()
+
+
+def _record_info(record):
+    """Return timestamp, cache_expires and status of an encoded record."""
+    _, _, _, status, timestamp, cache_expires, *_ = _RECORD_HEADER.unpack_from(record)
+    return (
+        timestamp,
+        None if math.isnan(cache_expires) else cache_expires,
+        status or None,
+    )
+
+
+class FeedsPackCacheStorage:
+    """Cache storage that appends entries to per-spider segment files.
+
+    Writes are appended to the current segment, hits are served from memory
+    mapped segments via an in-memory index. Removed and expired entries are
+    only marked with tombstones, compaction rewrites the live records once
+    enough of the segments is garbage. This suits the bursty write pattern of a
+    crawl much better than creating a file per entry.
+    """
+
+    # Packs are shared by all storages of a process (spider and downloader
+    # middleware and FeedsCache), otherwise their indexes would diverge.
+    _packs = {}
+    _packs_lock = threading.Lock()
+
+    def __init__(self, settings):
+        self.cachedir = data_path(settings["HTTPCACHE_DIR"])
+        self.expiration_secs = settings.getint("HTTPCACHE_EXPIRATION_SECS")
+        self.ignore_http_codes = [
+            int(x) for x in settings.getlist("HTTPCACHE_IGNORE_HTTP_CODES")
+        ]
+        self.negative_cache = _NegativeCache(settings)
+        self.codec = _get_codec(settings)
+
+    def _get_pack(self, spider_name):
+        path = os.path.join(self.cachedir, spider_name, "pack")
+        with self._packs_lock:
+            if path not in self._packs:
+                self._packs[path] = _Pack(path)
+            return self._packs[path]
+
+    def open_spider(self, spider):
+        logger.debug(f"Using pack cache storage in {self.cachedir}")
+
+    def close_spider(self, spider):
+        pack = self._get_pack(spider.name)
+        pack.close()
+        if pack.garbage_ratio > _PACK_COMPACT_RATIO:
+            logger.debug(f"Compacting cache of spider {spider.name} in background")
+            threading.Thread(target=pack.compact).start()
+
+    def retrieve_response(self, spider, request):
+        """Return response if present in cache, or None otherwise."""
+        key = cache_fingerprint(request, spider)
+        record = self._read_record(self._get_pack(spider.name), key)
+        if record is None:
+            return None
+        if record.status in self.ignore_http_codes and not (
+            self.negative_cache.is_fresh(record.status, record.timestamp)
+        ):
+            # ignore cache entry for error responses
+            logger.debug(f"Response for {request} not cached")
+            return None
+        logger.debug(f"Retrieved response for {request} from cache")
+        return _build_response(
+            record.response_url, record.status, record.headers, record.body
+        )
+
+    def store_response(self, spider, request, response):
+        """Store the given response in the cache."""
+        pack = self._get_pack(spider.name)
+        key = cache_fingerprint(request, spider)
+        cache_expires = request.meta.get("cache_expires")
+        if cache_expires is not None:
+            cache_expires = cache_expires.total_seconds()
+        # Parents of older entries are kept.
+        parents = set(_parent_fingerprints(request))
+        old_record = self._read_record(pack, key)
+        if old_record is not None:
+            parents.update(old_record.parents)
+        record = _CacheRecord(
+            type="response",
+            status=response.status,
+            timestamp=time(),
+            cache_expires=cache_expires,
+            parents=sorted(parents),
+            method=request.method,
+            url=request.url,
+            response_url=response.url,
+            headers=headers_dict_to_raw(response.headers),
+            body=response.body,
+        )
+        pack.append(key, _encode_record(record, self.codec))
+
+    def retrieve_object(self, spider, key):
+        record = self._read_record(
+            self._get_pack(spider.name), hashlib.sha1(to_bytes(key)).digest()
+        )
+        if record is None:
+            return None
+        return pickle.loads(record.body)
+
+    def _read_record(self, pack, key):
+        data = pack.read(key)
+        if data is None:
+            return None
+        try:
+            return _decode_record(data)
+        except _DECODE_ERRORS as e:
+            # The entry is treated as missing.
+            logger.warning(
+                f"Removing corrupt cache entry {key.hex()} from {pack.path}: {e!r}"
+            )
+            pack.remove(key)
+            return None
+
+    def store_object(self, spider, key, obj):
+        record = _CacheRecord(
+            type="object",
+            status=None,
+            timestamp=time(),
+            cache_expires=None,
+            parents=[],
+            method=None,
+            url=None,
+            response_url=None,
+            headers=b"",
+            body=pickle.dumps(obj),
+        )
+        self._get_pack(spider.name).append(
+            hashlib.sha1(to_bytes(key)).digest(), _encode_record(record, self.codec)
+        )
+
+    def remove_response(self, response, spider):
+        self.remove_responses([response], spider)
+
+    def remove_responses(self, responses, spider):
+        self.remove_fingerprints(
+            [cache_fingerprint(r.request, spider) for r in responses], spider
+        )
+
+    def remove_fingerprints(self, fingerprints, spider):
+        """Remove the entries of request fingerprints and their parents.
+
+        Entries shared by several requests (usually the parents) are only
+        removed once.
+        """
+        pack = self._get_pack(spider.name)
+        keys = set(fingerprints)
+        stats = FeedsCacheStats.for_spider(spider)
+        with stats.timed("remove_response"):
+            entries = set(keys)
+            cascaded = 0
+            for key in keys:
+                record = self._read_record(pack, key)
+                if record is not None:
+                    cascaded += len(record.parents)
+                    entries.update(bytes.fromhex(fpr) for fpr in record.parents)
+            removed = sum(pack.remove(key) for key in entries)
+        stats.inc("remove_response", len(fingerprints))
+        stats.inc("removed", removed)
+        stats.inc("removals_collapsed", len(fingerprints) + cascaded - len(entries))
+
+    def close(self):
+        # Packs are shared by all storages of the process and closed when the
+        # spider is closed.
+        pass
+
+    def _remove_entry(self, pack, key, remove_parents=False):
+        """Remove an entry and return the number of removed records."""
+        removed = 0
+        if remove_parents:
+            record = self._read_record(pack, key)
+            for fpr in record.parents if record is not None else []:
+                removed += pack.remove(bytes.fromhex(fpr))
+        return removed + pack.remove(key)
+
+    def cleanup(self, spiders=None):
+        """Removes cache entries.
+
+        Entries are removed if one of the conditions is true:
+          - Response has a certain status code (e.g. 404).
+          - Individual expiration date is reached (compared to now).
+          - Timestamp of entry and expires exceeds now.
+
+        Removed entries are only marked as removed; segments are compacted if
+        enough of them is garbage. If spiders is given, only entries of these
+        spiders are removed.
+        """
+        logger.debug(f"Cleaning cache entries from {self.cachedir} ...")
+
+        stats = CleanupStats()
+        if not os.path.isdir(self.cachedir):
+            # Nothing has been cached yet.
+            return stats
+        now = int(datetime.now(timezone.utc).timestamp())
+        if spiders is None:
+            spiders = os.listdir(self.cachedir)
+        for spider_name in sorted(spiders):
+            if not os.path.isdir(os.path.join(self.cachedir, spider_name, "pack")):
+                continue
+            pack = self._get_pack(spider_name)
+            with pack.locked():
+                entries = list(pack.entries.items())
+            for key, (_, _, _, timestamp, cache_expires, status) in entries:
+                if cache_expires is None:
+                    cache_expires = self.expiration_secs
+                entry_expires_after = min(cache_expires, self.expiration_secs)
+                if now > timestamp + entry_expires_after:
+                    stats.removed += self._remove_entry(pack, key)
+                elif status in self.ignore_http_codes and not (
+                    self.negative_cache.is_fresh(status, timestamp, now)
                 ):
-                    self.remove_cache_entry(cache_entry_path, remove_parents=True)
-            elif not os.path.samefile(cache_entry_path, self.cachedir):
-                # Try to delete parent directory of cache entries.
-                try:
-                    os.rmdir(cache_entry_path)
-                except OSError:
-                    # Not empty, don't care.
-                    pass
+                    stats.removed += self._remove_entry(pack, key, remove_parents=True)
+            stats.scanned += len(entries)
+            if pack.garbage_ratio > _PACK_COMPACT_RATIO:
+                # Space is only freed by compaction.
+                size = pack.size
+                pack.compact()
+                stats.bytes_freed += max(size - pack.size, 0)
+            pack.save_index()
 
         logger.debug("Finished cleaning cache entries.")
+        return stats
+
+
+class FeedsCacheLRU:
+    """Mapping that evicts the least recently used items above max_bytes.
+
+    The size of an item has to be given when it is set.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
 
-    def remove_cache_entry(self, cache_entry_path, remove_parents=False):
-        meta = self._read_meta_from_path(cache_entry_path)
-        if meta is None:
+    def get(self, key, default=None):
+        try:
+            self._items.move_to_end(key)
+        except KeyError:
+            return default
+        return self._items[key][0]
+
+    def set(self, key, value, size):
+        old = self._items.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+        if size > self.max_bytes:
             return
+        self._items[key] = (value, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, evicted_size) = self._items.popitem(last=False)
+            self.size -= evicted_size
 
-        if remove_parents and "parents" in meta:
-            spider_root = os.path.dirname(os.path.dirname(cache_entry_path))
-            for fpr in meta["parents"]:
-                path = os.path.join(spider_root, fpr[0:2], fpr)
-                self.remove_cache_entry(path, remove_parents=False)
+    def __contains__(self, key):
+        return key in self._items
 
-        shutil.rmtree(cache_entry_path, ignore_errors=True)
+    def __len__(self):
+        return len(self._items)
 
 
 class FeedsCacheInMemoryStorage:
-    def __init__(self):
-        self.data = defaultdict(dict)
+    """Object storage used if caching is disabled.
+
+    Objects are kept in a bounded LRU cache, i.e. least recently used objects
+    are forgotten once the memory limit is reached.
+    """
+
+    def __init__(self, max_bytes):
+        self.data = FeedsCacheLRU(max_bytes)
 
     def retrieve_object(self, spider, key):
-        return self.data[spider].get(key)
+        return self.data.get((spider.name, key))
 
     def store_object(self, spider, key, obj):
-        self.data[spider][key] = obj
+        self.data.set((spider.name, key), obj, len(pickle.dumps(obj)))
 
-    def cleanup(self):
-        pass
+    def cleanup(self, spiders=None):
+        return CleanupStats()
+
+
+class FeedsCacheRemovals:
+    """Queue of requests whose cache entries should be removed.
+
+    Requests are queued if their items or their responses are dropped. Only
+    their fingerprints are kept. The queue is de-duplicated by fingerprint and
+    flushed in one batch, e.g. when the spider is idle, so parents shared by
+    many dropped responses are only removed once and the removals don't block
+    the reactor.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self._pending = defaultdict(dict)
+        # Removals run in a thread of their own which keeps one storage, as
+        # connections to SQLite databases can't be shared between threads.
+        self._pool = None
+        self._storage = None
+
+    def add(self, response, spider):
+        fingerprints = self._pending[spider]
+        fpr = cache_fingerprint(response.request, spider)
+        if fpr in fingerprints:
+            FeedsCacheStats.for_spider(spider).inc("removals_collapsed")
+        else:
+            fingerprints[fpr] = None
+
+    def __len__(self):
+        return sum(len(fingerprints) for fingerprints in self._pending.values())
+
+    def flush(self, spider):
+        """Remove the queued entries in a thread and return a Deferred."""
+        fingerprints = list(self._pending.pop(spider, {}))
+        if not fingerprints:
+            return defer.succeed(None)
+        d = self._defer_to_thread(self._remove, fingerprints, spider)
+        d.addErrback(
+            lambda f: logger.error(
+                "Error while removing cache entries",
+                exc_info=failure_to_exc_info(f),
+                extra={"spider": spider},
+            )
+        )
+        return d
+
+    def close(self):
+        """Close the storage, stop the thread and return a Deferred."""
+        if self._pool is None:
+            return defer.succeed(None)
+        pool, self._pool = self._pool, None
+        d = deferToThreadPool(_reactor(), pool, self._close_storage)
+        d.addErrback(
+            lambda f: logger.error(
+                "Error while closing cache storage", exc_info=failure_to_exc_info(f)
+            )
+        )
+        d.addBoth(lambda _: pool.stop())
+        return d
+
+    def _defer_to_thread(self, f, *args):
+        if self._pool is None:
+            self._pool = ThreadPool(1, 1, name="FeedsCacheRemovals")
+            self._pool.start()
+        return deferToThreadPool(_reactor(), self._pool, f, *args)
+
+    def _get_storage(self):
+        if self._storage is None:
+            self._storage = load_object(self.settings["HTTPCACHE_STORAGE"])(
+                self.settings
+            )
+        return self._storage
+
+    def _remove(self, fingerprints, spider):
+        logger.debug(f"Removing {len(fingerprints)} responses from cache")
+        self._get_storage().remove_fingerprints(fingerprints, spider)
+
+    def _close_storage(self):
+        if self._storage is not None:
+            self._storage.close()
+            self._storage = None
+
+
+def _reactor():
+    # The reactor is installed by the crawler process.
+    from twisted.internet import reactor
+
+    return reactor
@@ -3,19 +3,28 @@ import os
 
 import click
 from scrapy.crawler import CrawlerProcess
-from scrapy.utils.log import configure_logging
+from scrapy.utils.log import configure_logging, failure_to_exc_info
+from scrapy.utils.misc import load_object
 from scrapy.utils.project import get_project_settings
+from twisted.internet.defer import DeferredList
+from twisted.internet.error import ReactorNotRunning
+from twisted.internet.threads import deferToThread
 from twisted.python import failure
 
-from feeds.cache import FeedsCache
+from feeds.cache import FeedsCache, FeedsPackCacheStorage, FeedsSqliteCacheStorage
 from feeds.settings import load_feeds_settings
 
 logger = logging.getLogger(__name__)
 
 
-def run_cleanup_cache(settings):
+def run_cleanup_cache(settings, spiders=None):
     cache = FeedsCache(settings)
-    cache.cleanup()
+    if spiders is None:
+        cache.cleanup()
+    else:
+        cache.cleanup(
+            spiders, min_interval=settings.getint("HTTPCACHE_CLEANUP_INTERVAL")
+        )
 
 
 def spiders_to_crawl(process, argument_spiders):
@@ -96,10 +105,43 @@ def crawl(ctx, spiders, stats):
             logger.info(f"Starting crawl of {spider} ...")
             process.crawl(spider)
 
-    process.start()
-
-    if settings.getbool("HTTPCACHE_ENABLED"):
-        run_cleanup_cache(settings)
+    # Only clean up the cache of spiders that ran.
+    cleanup_cache = spiders and settings.getbool("HTTPCACHE_ENABLED")
+    background = cleanup_cache and settings.getbool("HTTPCACHE_CLEANUP_BACKGROUND")
+    if background and issubclass(
+        load_object(settings["HTTPCACHE_STORAGE"]), FeedsPackCacheStorage
+    ):
+        # Compacting packs while the spiders store and remove entries is not
+        # safe yet.
+        logger.warning(
+            "The pack cache storage is not cleaned up in the background, "
+            "cleaning up after crawling instead."
+        )
+        background = False
+    if background:
+        # The reactor is installed by CrawlerProcess.
+        from twisted.internet import reactor
+
+        def stop_reactor(_):
+            try:
+                reactor.stop()
+            except ReactorNotRunning:
+                # Already stopping, e.g. after a signal.
+                pass
+
+        d = deferToThread(run_cleanup_cache, settings, spiders)
+        d.addErrback(
+            lambda f: logger.error(
+                "Error while cleaning up cache", exc_info=failure_to_exc_info(f)
+            )
+        )
+        # Stop once crawling and cleaning up are done.
+        DeferredList([process.join(), d]).addBoth(stop_reactor)
+        process.start(stop_after_crawl=False)
+    else:
+        process.start()
+        if cleanup_cache:
+            run_cleanup_cache(settings, spiders)
 
 
 @cli.command()
@@ -133,5 +175,29 @@ def cleanup(ctx):
     run_cleanup_cache(settings)
 
 
+@cli.command("migrate-cache")
+@click.option(
+    "--remove/--keep",
+    default=False,
+    help="Remove imported entries from the file system cache.",
+)
+@click.pass_context
+def migrate_cache(ctx, remove):
+    """
+    Import a file system cache into the SQLite cache.
+
+    Entries of the file system cache in the configured cache dir are imported
+    into the SQLite database in the same directory. Use ``cache_storage = sqlite``
+    afterwards to use the imported entries.
+    """
+    settings = ctx.obj["settings"]
+    # Manually configure logging since we don't have a CrawlerProcess which
+    # would take care of that.
+    configure_logging(settings)
+
+    storage = FeedsSqliteCacheStorage(settings)
+    storage.import_filesystem_cache(remove=remove)
+
+
 def main():
     cli(obj={})
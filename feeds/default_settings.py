@@ -7,6 +7,10 @@ from xdg.BaseDirectory import save_cache_path, xdg_config_home
 FEEDS_CONFIG_OUTPUT_PATH = "output"
 FEEDS_CONFIG_FILE = os.path.join(xdg_config_home, "feeds.cfg")
 FEEDS_CONFIG_CACHE_EXPIRES = 90
+# Memory for cached objects in MiB.
+FEEDS_CONFIG_CACHE_MEMORY_LIMIT = 32
+# Maximum number of entries of a feed (0 means unlimited).
+FEEDS_CONFIG_MAX_ENTRIES = 0
 
 # Low level settings intended for scrapy.
 # Please use feeds.cfg to configure feeds.
@@ -45,6 +49,29 @@ HTTPCACHE_POLICY = "feeds.cache.FeedsCachePolicy"
 HTTPCACHE_DIR = save_cache_path("feeds")
 HTTPCACHE_EXPIRATION_SECS = FEEDS_CONFIG_CACHE_EXPIRES * 24 * 60 * 60
 HTTPCACHE_IGNORE_HTTP_CODES = list(range(400, 600))
+# Ignored responses with these codes are still used from the cache for a short
+# time so that e.g. dead links are not requested on every crawl.
+HTTPCACHE_NEGATIVE_HTTP_CODES = [404, 410]
+HTTPCACHE_NEGATIVE_EXPIRATION_SECS = 24 * 60 * 60
+# Compression of cached bodies: none, gzip or zstd (requires zstandard).
+HTTPCACHE_COMPRESSION = "gzip"
+# Store identical bodies only once (file system storage only).
+HTTPCACHE_DEDUPLICATE = False
+HTTPCACHE_DEDUPLICATE_MIN_SIZE = 4096
+# Write human readable metadata next to cache entries.
+HTTPCACHE_DEBUG_META = False
+# Send conditional requests for uncached requests and replay the last response on 304.
+HTTPCACHE_REVALIDATE = False
+# Use the last response of uncached requests if they fail.
+HTTPCACHE_STALE_IF_ERROR = False
+# Minimum time between cleanups of the cache of a spider after crawls.
+HTTPCACHE_CLEANUP_INTERVAL = 60 * 60
+# Threads used to read and remove cache files during cleanup.
+HTTPCACHE_CLEANUP_THREADS = 8
+# Clean up the cache while crawling instead of afterwards.
+HTTPCACHE_CLEANUP_BACKGROUND = False
+# Maximum size of the cache in bytes (0 means no limit), see also cache_quota.
+HTTPCACHE_QUOTA = 0
 
 # Do not enable cookies by default to make better use of the cache.
 COOKIES_ENABLED = False
@@ -1,13 +1,155 @@
 from scrapy import signals
 from scrapy.downloadermiddlewares.httpcache import HttpCacheMiddleware
+from w3lib.http import headers_dict_to_raw
+
+from feeds.cache import FeedsCacheRemovals, _build_response, cache_fingerprint
 
 
 class FeedsHttpCacheMiddleware(HttpCacheMiddleware):
+    """HTTP cache middleware that also keeps the last response of uncached requests.
+
+    Responses of requests with ``dont_cache`` are never cached. If
+    ``HTTPCACHE_REVALIDATE`` or ``HTTPCACHE_STALE_IF_ERROR`` is enabled, the last
+    response of such a request is kept in the cache storage.
+
+    With ``HTTPCACHE_REVALIDATE`` the request is sent conditionally using the
+    validators (ETag and Last-Modified) of the kept response and a 304 response
+    is replaced by the kept response.
+
+    With ``HTTPCACHE_STALE_IF_ERROR`` the kept response is used if the request
+    fails with a server error or a download error and won't be retried anymore.
+
+    Cache entries of dropped items are removed in batches when the spider is idle
+    or closed.
+    """
+
+    def __init__(self, settings, stats):
+        super().__init__(settings, stats)
+        self.revalidate = settings.getbool("HTTPCACHE_REVALIDATE")
+        self.stale_if_error = settings.getbool("HTTPCACHE_STALE_IF_ERROR")
+        self.retry_enabled = settings.getbool("RETRY_ENABLED")
+        self.max_retry_times = settings.getint("RETRY_TIMES")
+        self.retry_http_codes = {int(x) for x in settings.getlist("RETRY_HTTP_CODES")}
+        self.removals = FeedsCacheRemovals(settings)
+
     @classmethod
     def from_crawler(cls, crawler):
         o = super().from_crawler(crawler)
+        o.crawler = crawler
         crawler.signals.connect(o.item_dropped, signal=signals.item_dropped)
+        crawler.signals.connect(o.spider_idle, signal=signals.spider_idle)
         return o
 
     def item_dropped(self, item, response, exception, spider):
-        self.storage.remove_response(response, spider)
+        self.removals.add(response, spider)
+
+    def spider_idle(self, spider):
+        self.removals.flush(spider)
+
+    def spider_closed(self, spider):
+        # Remove pending entries before the storage is closed.
+        close_storage = super().spider_closed
+        d = self.removals.flush(spider)
+        d.addBoth(lambda _: self.removals.close())
+        d.addBoth(lambda _: close_storage(spider))
+        return d
+
+    def process_request(self, request, *args):
+        if self._keeps_response(request):
+            stored = self.storage.retrieve_object(
+                self.crawler.spider, self._get_revalidate_key(request)
+            )
+            if stored is not None:
+                if self.revalidate and stored["etag"]:
+                    request.headers.setdefault("If-None-Match", stored["etag"])
+                if self.revalidate and stored["last_modified"]:
+                    request.headers.setdefault(
+                        "If-Modified-Since", stored["last_modified"]
+                    )
+                # Keep the stored response to avoid a second lookup.
+                request.meta["stored_response"] = stored
+        return super().process_request(request, *args)
+
+    def process_response(self, request, response, *args):
+        if self._keeps_response(request):
+            return self._process_uncached_response(request, response)
+        return super().process_response(request, response, *args)
+
+    def process_exception(self, request, exception, *args):
+        if (
+            self.stale_if_error
+            and isinstance(exception, self.DOWNLOAD_EXCEPTIONS)
+            and self._retries_exhausted(request)
+        ):
+            stored = request.meta.pop("stored_response", None)
+            if stored is not None:
+                return self._stale_response(stored)
+        return super().process_exception(request, exception, *args)
+
+    def _keeps_response(self, request):
+        return (
+            (self.revalidate or self.stale_if_error)
+            and request.meta.get("dont_cache", False)
+            and request.method == "GET"
+        )
+
+    def _retries_exhausted(self, request, status=None):
+        if not self.retry_enabled or request.meta.get("dont_retry", False):
+            return True
+        if status is not None and status not in self.retry_http_codes:
+            return True
+        max_retry_times = request.meta.get("max_retry_times", self.max_retry_times)
+        return request.meta.get("retry_times", 0) >= max_retry_times
+
+    def _get_revalidate_key(self, request):
+        return "revalidate|{}".format(
+            cache_fingerprint(request, self.crawler.spider).hex()
+        )
+
+    def _process_uncached_response(self, request, response):
+        stored = request.meta.pop("stored_response", None)
+        if "stale" in response.flags or "revalidated" in response.flags:
+            return response
+
+        if response.status == 304 and self.revalidate:
+            if stored is None:
+                return response
+            self.stats.inc_value("httpcache/revalidate")
+            response = _build_response(
+                stored["url"], stored["status"], stored["headers"], stored["body"]
+            )
+            response.flags.append("revalidated")
+            return response
+
+        if (
+            response.status >= 500
+            and self.stale_if_error
+            and stored is not None
+            and self._retries_exhausted(request, response.status)
+        ):
+            return self._stale_response(stored)
+
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if response.status == 200 and (self.stale_if_error or etag or last_modified):
+            self.storage.store_object(
+                self.crawler.spider,
+                self._get_revalidate_key(request),
+                {
+                    "etag": etag,
+                    "last_modified": last_modified,
+                    "url": response.url,
+                    "status": response.status,
+                    "headers": headers_dict_to_raw(response.headers),
+                    "body": response.body,
+                },
+            )
+        return response
+
+    def _stale_response(self, stored):
+        self.stats.inc_value("httpcache/stale_if_error")
+        response = _build_response(
+            stored["url"], stored["status"], stored["headers"], stored["body"]
+        )
+        response.flags.append("stale")
+        return response
@@ -1,6 +1,11 @@
+import filecmp
+import hashlib
+import heapq
 import logging
 import os
-from copy import deepcopy
+import shutil
+import tempfile
+from collections import namedtuple
 from urllib.parse import urljoin
 
 from lxml import etree
@@ -10,64 +15,159 @@ from feeds.items import FeedEntryItem, FeedItem
 
 logger = logging.getLogger(__name__)
 
+_SerializedEntry = namedtuple("_SerializedEntry", ["id", "key", "offset", "length"])
+
 
 class AtomExporter(BaseItemExporter):
     class AtomFeed:
-        def __init__(self, exporter, link_self=None):
+        """An Atom feed that is written incrementally.
+
+        Entries are serialized as soon as they are added and spilled to the
+        temporary file of the exporter. Only the feed header, the ids and the
+        sort keys and offsets of the entries are kept in memory.
+
+        Items are not modified. An entry that belongs to several feeds is
+        serialized once with serialize_entry() and added to every feed with
+        add_entry().
+
+        If max_entries is set, only the newest entries are kept. Entries that are
+        older than all entries of a full feed are rejected by accepts() before
+        they are converted.
+        """
+
+        def __init__(self, exporter, link_self=None, pretty_print=True, max_entries=0):
             self._exporter = exporter
             self._link_self = link_self
+            self._pretty_print = pretty_print
+            self._max_entries = max_entries
             self._feed_updated = None
+            self._header = []
+            # Min-heap of sort key, negated sequence number, offset and length of
+            # the serialized entries. The oldest entry is at the top; of entries
+            # with the same key the one added last.
             self._feed_items = []
-            self._xml = etree.Element(
-                "feed", nsmap={None: "http://www.w3.org/2005/Atom"}
-            )
+            self._count = 0
             self._ids = set()
 
         def add_item(self, item):
             if isinstance(item, FeedItem):
                 if self._link_self:
+                    item = item.copy()
                     item["link_self"] = self._link_self
                 for child in self._convert_feed_item(item):
-                    self._xml.insert(0, child)
+                    if child.tag == "updated":
+                        self._update_updated(child.text)
+                    self._header.insert(0, child)
             elif isinstance(item, FeedEntryItem):
-                if item["id"] not in self._ids:
-                    self._ids.add(item["id"])
-                    entry = etree.Element("entry")
-                    for child in self._convert_feed_item(item):
-                        entry.append(child)
-                    self._feed_items.append(entry)
-                else:
-                    logger.debug(
-                        "Feed entry with id '{}' already in feed.".format(item["id"])
+                key = self.sort_key(item)
+                if self.accepts(item["id"], key):
+                    self.add_entry(self.serialize_entry(item, key))
+
+        def sort_key(self, item, fields=("updated", "id")):
+            """Return the key of an entry item; entries are sorted newest first."""
+            return tuple(
+                (
+                    self._exporter.serialize_field(
+                        item.fields[field], field, item[field]
                     )
+                    if item.get(field) is not None
+                    else ""
+                )
+                for field in fields
+            )
+
+        def accepts(self, entry_id, key):
+            """Return True if an entry would be added to the feed."""
+            if entry_id in self._ids:
+                logger.debug(f"Feed entry with id '{entry_id}' already in feed.")
+                return False
+            if (
+                self._max_entries
+                and len(self._feed_items) >= self._max_entries
+                and (key, -self._count) < self._feed_items[0][:2]
+            ):
+                # Like entries that are evicted later, the first entry with an id
+                # wins.
+                self._ids.add(entry_id)
+                return False
+            return True
+
+        def serialize_entry(self, item, key=None):
+            """Convert an entry item to a serialized entry for add_entry()."""
+            if key is None:
+                key = self.sort_key(item)
+            entry = etree.Element("entry")
+            for child in self._convert_feed_item(item):
+                entry.append(child)
+            self._indent(entry)
+            data = etree.tostring(entry, encoding=self._encoding, xml_declaration=False)
+            return _SerializedEntry(
+                item["id"], key, self._exporter._spill(data), len(data)
+            )
+
+        def add_entry(self, entry):
+            if not self.accepts(entry.id, entry.key):
+                return
+            self._ids.add(entry.id)
+            self._update_updated(entry.key[0])
+            record = (entry.key, -self._count, entry.offset, entry.length)
+            self._count += 1
+            if self._max_entries and len(self._feed_items) >= self._max_entries:
+                # The data of evicted entries stays in the temporary file.
+                heapq.heapreplace(self._feed_items, record)
+            else:
+                heapq.heappush(self._feed_items, record)
 
         def insert_updated(self):
             child = etree.Element("updated")
             child.text = self._feed_updated
-            self._xml.insert(0, child)
-
-        def sort(self, fields=("updated", "id"), default=0, reverse=True):
-            for item in sorted(
-                self._feed_items,
-                reverse=reverse,
-                key=lambda k: tuple(
-                    k.findtext(field, default=default) for field in fields
-                ),
-            ):
-                self._xml.append(item)
-
-        def tostring(self, **kwargs):
-            return etree.tostring(self._xml, **kwargs)
+            self._header.insert(0, child)
+
+        def write(self, f):
+            """Write the feed to the binary file f, entries sorted by date."""
+            encoding = self._encoding
+            with etree.xmlfile(f, encoding=encoding) as xf:
+                xf.write_declaration()
+                with xf.element("feed", nsmap={None: "http://www.w3.org/2005/Atom"}):
+                    for child in self._header:
+                        self._indent(child)
+                        xf.write(self._separator)
+                        xf.write(child)
+                    xf.flush()
+                    sep = self._separator.encode(encoding)
+                    # Only the lightweight records are sorted. Entries with the
+                    # same key keep the order they were added in.
+                    for _, _, offset, length in sorted(self._feed_items, reverse=True):
+                        f.write(sep + self._exporter._read_spilled(offset, length))
+                    if self._pretty_print:
+                        xf.write("\n")
+            if self._pretty_print:
+                f.write(b"\n")
 
         def __len__(self):
             return len(self._feed_items)
 
+        @property
+        def _encoding(self):
+            # Like etree.tostring(), default to ASCII with character references.
+            return self._exporter.encoding or "ASCII"
+
+        @property
+        def _separator(self):
+            return "\n  " if self._pretty_print else ""
+
+        def _indent(self, element):
+            if self._pretty_print:
+                etree.indent(element, level=1)
+
         def _convert_feed_item(self, item):
             xml_items = []
+            # Fields that are converted specially.
+            converted = set()
 
             # Convert author related fields.
             author_item = self._convert_special_nested(
-                item, "author", ("name", "email")
+                item, "author", ("name", "email"), converted
             )
             if author_item is not None:
                 xml_items.append(author_item)
@@ -76,53 +176,53 @@ class AtomExporter(BaseItemExporter):
             key = "link"
             if key in item:
                 xml_items.append(self._convert_special_link(item, key, "alternate"))
-                item.pop(key)
+                converted.add(key)
 
             # Convert link
             key = "link_self"
             if key in item:
                 xml_items.append(self._convert_special_link(item, key, "self"))
-                item.pop(key)
+                converted.add(key)
 
             # Convert content
             for key in ("content_text", "content_html"):
                 if key in item:
                     xml_items.append(self._convert_special_content(item, key))
-                    item.pop(key)
+                    converted.add(key)
 
             # Convert enclosure
             key = "enclosure"
             if key in item:
                 for enclosure in self._convert_special_enclosure(item, key):
                     xml_items.append(enclosure)
-                item.pop(key)
+                converted.add(key)
 
             key = "category"
             if key in item:
                 for category in self._convert_special_category(item, key):
                     xml_items.append(category)
-                item.pop(key)
+                converted.add(key)
 
             # Convert remaining fields.
             for name, value in self._exporter._get_serialized_fields(
                 item, default_value=""
             ):
+                if name in converted:
+                    continue
                 element = etree.Element(name)
                 element.text = value
                 xml_items.append(element)
-                if name == "updated":
-                    self._update_updated(value)
 
             return xml_items
 
-        def _convert_special_nested(self, item, parent, children, sep="_"):
+        def _convert_special_nested(self, item, parent, children, converted, sep="_"):
             children_items = []
             for full_key in [sep.join((parent, child)) for child in children]:
                 if full_key in item:
                     children_items.append(
                         self._convert_special_single_element(item, full_key, sep)
                     )
-                    item.pop(full_key)
+                    converted.add(full_key)
             if children_items:
                 element = etree.Element(parent)
                 for children_item in children_items:
@@ -169,53 +269,161 @@ class AtomExporter(BaseItemExporter):
             if self._feed_updated is None or self._feed_updated < raw_updated:
                 self._feed_updated = raw_updated
 
-    def __init__(self, output_path, output_url, name, **kwargs):
+    def __init__(
+        self,
+        output_path,
+        output_url,
+        name,
+        max_entries=0,
+        max_entries_per_path=None,
+        **kwargs,
+    ):
         self._configure(kwargs)
         self._output_path = output_path
         self._output_url = output_url
         self._name = name
+        # Maximum number of entries of a feed (0 means unlimited).
+        self._max_entries = max_entries
+        self._max_entries_per_path = max_entries_per_path or {}
         self._feeds = {}
         self._pretty_print = kwargs.pop("pretty_print", True)
+        # Serialized entries of all feeds are spilled to a single temporary
+        # file which is created with the first entry.
+        self._entries = None
 
     def finish_exporting(self):
-        for path, feed in self._feeds.items():
-            path = os.path.join(self._output_path, path)
-            if len(feed) == 0:
-                logger.warning(f"Feed '{path}' contains no items!")
-
-            feed.insert_updated()
-            feed.sort()
-            feed = feed.tostring(
-                encoding=self.encoding,
-                pretty_print=self._pretty_print,
-                xml_declaration=True,
-            )
-            os.makedirs(os.path.dirname(path), exist_ok=True)
-            try:
-                with open(path, "rb") as f:
-                    logger.debug(f"Found existing feed at '{path}'")
-                    old_feed = f.read()
-            except FileNotFoundError:
-                old_feed = None
-            if feed != old_feed:
-                with open(path, "wb") as f:
-                    f.write(feed)
-            else:
-                logger.debug(f"Feed content not changed, not overwriting feed '{path}'")
+        try:
+            for path, feed in self._feeds.items():
+                self._write_feed(os.path.join(self._output_path, path), feed)
+        finally:
+            if self._entries is not None:
+                self._entries.close()
+                self._entries = None
+
+    def _write_feed(self, path, feed):
+        if len(feed) == 0:
+            logger.warning(f"Feed '{path}' contains no items!")
+
+        feed.insert_updated()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # The feed is written to a temporary file and renamed so that it is
+        # replaced atomically. The digest is computed while writing.
+        digest = hashlib.sha256()
+        f = tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(path), prefix=".feed.", delete=False
+        )
+        try:
+            with f:
+                feed.write(_DigestWriter(f, digest))
+        except BaseException:
+            os.remove(f.name)
+            raise
+        digest = digest.hexdigest()
+        digest_path = _get_digest_path(path)
+        old_digest = None
+        if os.path.exists(path):
+            logger.debug(f"Found existing feed at '{path}'")
+            old_digest = _read_digest(digest_path)
+            if old_digest is None and filecmp.cmp(f.name, path, shallow=False):
+                # Feeds written without a digest are compared once.
+                _write_digest(digest_path, digest)
+                old_digest = digest
+        if digest == old_digest:
+            logger.debug(f"Feed content not changed, not overwriting feed '{path}'")
+            os.remove(f.name)
+            return
+        if os.path.exists(path):
+            shutil.copymode(path, f.name)
+        else:
+            # Temporary files are only readable by the owner.
+            os.chmod(f.name, 0o644)
+        os.replace(f.name, path)
+        _write_digest(digest_path, digest)
+
+    def _spill(self, data):
+        """Append a serialized entry to the temporary file, return its offset."""
+        if self._entries is None:
+            self._entries = tempfile.TemporaryFile()
+        offset = self._entries.seek(0, os.SEEK_END)
+        self._entries.write(data)
+        return offset
+
+    def _read_spilled(self, offset, length):
+        self._entries.seek(offset)
+        return self._entries.read(length)
 
     def export_item(self, item):
-        for path in item.pop("path", [""]):
-            path = os.path.join(self._name, path, "feed.atom")
+        key = entry = None
+        for item_path in item.pop("path", [""]):
+            path = os.path.join(self._name, item_path, "feed.atom")
             if path not in self._feeds:
                 if self._output_url:
                     link_self = urljoin(self._output_url, path)
                 else:
                     link_self = None
-                self._feeds[path] = self.AtomFeed(exporter=self, link_self=link_self)
-            # add_item() is destructive, so add a copy.
-            self._feeds[path].add_item(deepcopy(item))
+                self._feeds[path] = self.AtomFeed(
+                    exporter=self,
+                    link_self=link_self,
+                    pretty_print=self._pretty_print,
+                    max_entries=self._max_entries_per_path.get(
+                        item_path, self._max_entries
+                    ),
+                )
+            feed = self._feeds[path]
+            if isinstance(item, FeedEntryItem):
+                if key is None:
+                    key = feed.sort_key(item)
+                # Entries that don't make it into a full feed are not converted.
+                if not feed.accepts(item["id"], key):
+                    continue
+                # Entries are the same in every feed, so serialize them only once.
+                if entry is None:
+                    entry = feed.serialize_entry(item, key)
+                feed.add_entry(entry)
+            else:
+                feed.add_item(item)
 
         # Pop content fields since we don't want to have them in scrapy's debug
         # output.
         item.pop("content_html", None)
         item.pop("content_text", None)
+
+
+class _DigestWriter:
+    """File wrapper that updates a digest with everything written."""
+
+    def __init__(self, f, digest):
+        self._f = f
+        self._digest = digest
+
+    def write(self, data):
+        self._digest.update(data)
+        return self._f.write(data)
+
+
+def _get_digest_path(path):
+    """Return the path of the hidden file that keeps the digest of a feed."""
+    head, tail = os.path.split(path)
+    return os.path.join(head, f".{tail}.sha256")
+
+
+def _read_digest(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def _write_digest(path, digest):
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            f.write(digest)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
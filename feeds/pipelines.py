@@ -83,11 +83,45 @@ class AtomExportPipeline:
         return pipeline
 
     def spider_opened(self, spider):
+        max_entries, max_entries_per_path = self._get_max_entries(spider)
         self._exporters[spider] = AtomExporter(
-            self._output_path, self._output_url, spider.name
+            self._output_path,
+            self._output_url,
+            spider.name,
+            max_entries=max_entries,
+            max_entries_per_path=max_entries_per_path,
         )
         self._exporters[spider].start_exporting()
 
+    def _get_max_entries(self, spider):
+        """Return the maximum number of entries of the feeds of a spider.
+
+        The max_entries setting of a spider consists of lines with a path and a
+        number; a line with only a number applies to all other feeds.
+        """
+        max_entries = spider.settings.getint("FEEDS_CONFIG_MAX_ENTRIES")
+        max_entries_per_path = {}
+        spider_key = spider.name.replace(".", "_").upper()
+        setting = spider.settings.get(f"FEEDS_SPIDER_{spider_key}_MAX_ENTRIES") or ""
+        for line in setting.splitlines():
+            if not line.strip():
+                continue
+            *path, value = line.split()
+            try:
+                if len(path) > 1:
+                    raise ValueError
+                value = int(value)
+            except ValueError:
+                raise ValueError(
+                    f"Invalid max_entries setting of spider {spider.name}: "
+                    f"{line.strip()!r}, expected an optional path and a number"
+                ) from None
+            if path:
+                max_entries_per_path[path[0]] = value
+            else:
+                max_entries = value
+        return max_entries, max_entries_per_path
+
     def spider_closed(self, spider):
         # Add feed header(s) at the end so they can be dynamic.
         for feed_header in spider.feed_headers():
@@ -8,6 +8,14 @@ logger = logging.getLogger(__name__)
 
 _SETTINGS = None
 
+# Mapping of cache_storage values to cache storage classes. Other values are used
+# as import path of a custom storage class.
+CACHE_STORAGES = {
+    "filesystem": "feeds.cache.FeedsCacheStorage",
+    "sqlite": "feeds.cache.FeedsSqliteCacheStorage",
+    "pack": "feeds.cache.FeedsPackCacheStorage",
+}
+
 
 def load_feeds_settings(file_):
     settings = get_project_settings()
@@ -43,6 +51,46 @@ def load_feeds_settings(file_):
         "LOG_LEVEL": (config.get, "loglevel", str),
         "HTTPCACHE_ENABLED": (config.getboolean, "cache_enabled", bool),
         "HTTPCACHE_DIR": (config.get, "cache_dir", os.path.expanduser),
+        "HTTPCACHE_STORAGE": (
+            config.get,
+            "cache_storage",
+            lambda s: CACHE_STORAGES.get(s, s),
+        ),
+        "HTTPCACHE_COMPRESSION": (config.get, "cache_compression", str),
+        "HTTPCACHE_DEDUPLICATE": (config.getboolean, "cache_deduplicate", bool),
+        "HTTPCACHE_DEBUG_META": (config.getboolean, "cache_debug_meta", bool),
+        "HTTPCACHE_REVALIDATE": (config.getboolean, "cache_revalidate", bool),
+        "HTTPCACHE_STALE_IF_ERROR": (
+            config.getboolean,
+            "cache_stale_if_error",
+            bool,
+        ),
+        "HTTPCACHE_CLEANUP_INTERVAL": (
+            config.getint,
+            "cache_cleanup_interval",
+            lambda m: m * 60,
+        ),
+        "HTTPCACHE_CLEANUP_THREADS": (config.getint, "cache_cleanup_threads", int),
+        "HTTPCACHE_CLEANUP_BACKGROUND": (
+            config.getboolean,
+            "cache_cleanup_background",
+            bool,
+        ),
+        "HTTPCACHE_QUOTA": (
+            config.getint,
+            "cache_quota",
+            lambda m: m * 1024 * 1024,
+        ),
+        "HTTPCACHE_NEGATIVE_HTTP_CODES": (
+            config.get,
+            "cache_negative_codes",
+            lambda c: [int(x) for x in c.split()],
+        ),
+        "HTTPCACHE_NEGATIVE_EXPIRATION_SECS": (
+            config.getint,
+            "cache_negative_expires",
+            lambda h: h * 60 * 60,
+        ),
         "HTTPCACHE_EXPIRATION_SECS": (
             config.getint,
             "cache_expires",
@@ -1,12 +1,10 @@
 import logging
-from copy import copy
 
 from scrapy import Request, signals
 from scrapy.exceptions import NotConfigured
 from scrapy.spidermiddlewares.httperror import HttpError
-from scrapy.utils.misc import load_object
-from scrapy.utils.request import fingerprint
 
+from feeds.cache import FeedsCacheRemovals, FingerprintChain, cache_fingerprint
 from feeds.exceptions import DropResponse
 
 logger = logging.getLogger(__name__)
@@ -38,7 +36,7 @@ class FeedsHttpCacheMiddleware:
     def __init__(self, settings):
         if not settings.getbool("HTTPCACHE_ENABLED"):
             raise NotConfigured
-        self.storage = load_object(settings["HTTPCACHE_STORAGE"])(settings)
+        self.removals = FeedsCacheRemovals(settings)
 
     @classmethod
     def from_crawler(cls, crawler):
@@ -46,6 +44,8 @@ class FeedsHttpCacheMiddleware:
 
         # Note: this hook is a bit of a hack to intercept redirections
         crawler.signals.connect(mw.request_scheduled, signal=signals.request_scheduled)
+        crawler.signals.connect(mw.spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(mw.spider_closed, signal=signals.spider_closed)
 
         return mw
 
@@ -53,28 +53,20 @@ class FeedsHttpCacheMiddleware:
         def _set_fingerprint(response, r):
             if isinstance(r, Request):
                 # Chain fingerprints of response.request and new requests together.
-                try:
-                    r.meta["fingerprints"] = copy(response.request.meta["fingerprints"])
-                except KeyError:
-                    r.meta["fingerprints"] = []
+                # The chain is immutable and therefore shared, not copied.
+                r.meta["fingerprints"] = response.request.meta.get("fingerprints")
             return r
 
         return (_set_fingerprint(response, r) for r in result or ())
 
     def request_scheduled(self, request, spider):
-        try:
-            request.meta["fingerprints"] = copy(request.meta["fingerprints"])
-        except KeyError:
-            request.meta["fingerprints"] = []
-        logger.debug(
-            "Parent fingerprints for request {}: {}".format(
-                request, request.meta["fingerprints"]
-            )
-        )
+        parents = request.meta.get("fingerprints")
+        logger.debug(f"Parent fingerprints for request {request}: {parents}")
         if not request.meta.get("dont_cache", False):
-            fpr = fingerprint(request, include_headers=["Cookie"])
-            request.meta["fingerprints"].append(fpr)
+            fpr = cache_fingerprint(request, spider)
+            request.meta["fingerprints"] = FingerprintChain(fpr, parents)
         else:
+            request.meta["fingerprints"] = parents
             logger.debug(f"Skipping fingerprinting uncached request {request}")
 
     def process_spider_exception(self, response, exception, spider):
@@ -87,5 +79,13 @@ class FeedsHttpCacheMiddleware:
             else:
                 lgr = logger.warning
             lgr(exception)
-            self.storage.remove_response(response, spider)
+            self.removals.add(response, spider)
             return []
+
+    def spider_idle(self, spider):
+        self.removals.flush(spider)
+
+    def spider_closed(self, spider):
+        d = self.removals.flush(spider)
+        d.addBoth(lambda _: self.removals.close())
+        return d
@@ -1,4 +1,5 @@
 import scrapy
+from scrapy import signals
 from scrapy.spiders import CrawlSpider, Spider, XMLFeedSpider
 
 from feeds.cache import FeedsCache
@@ -6,6 +7,12 @@ from feeds.utils import generate_feed_header
 
 
 class FeedsSpider(Spider):
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(spider._close_cache, signal=signals.spider_closed)
+        return spider
+
     def feed_headers(self):
         yield generate_feed_header(
             title=getattr(self, "feed_title", None),
@@ -28,6 +35,10 @@ class FeedsSpider(Spider):
             self._cache = FeedsCache(self.settings)
         return self._cache
 
+    def _close_cache(self):
+        if getattr(self, "_cache", None) is not None:
+            self._cache.close_spider(self)
+
 
 class FeedsCrawlSpider(CrawlSpider, FeedsSpider):
     pass
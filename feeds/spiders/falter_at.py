@@ -16,6 +16,7 @@ class FalterAtSpider(FeedsSpider):
     name = "falter.at"
     # Don't overwhelm the poor Wordpress with too many requests at once.
     custom_settings = {"DOWNLOAD_DELAY": 1.0, "COOKIES_ENABLED": True}
+    cache_cookie_policy = "names"
 
     def start_requests(self):
         pages = self.settings.get("FEEDS_SPIDER_FALTER_AT_PAGES")
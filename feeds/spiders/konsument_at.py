@@ -11,6 +11,7 @@ class KonsumentAtSpider(FeedsSpider):
     name = "konsument.at"
     start_urls = ["https://www.konsument.at/page/das-aktuelle-heft"]
     custom_settings = {"COOKIES_ENABLED": True}
+    cache_cookie_policy = "names"
 
     feed_title = "KONSUMENT.AT"
     feed_subtitle = "Objektiv, unbestechlich, keine Werbung"
@@ -65,6 +65,7 @@ class LwnNetSpider(FeedsXMLFeedSpider):
     iterator = "iternodes"
     # lwn.net doesn't like it (i.e. blocks us) if we impose too much load.
     custom_settings = {"DOWNLOAD_DELAY": 1.0, "COOKIES_ENABLED": True}
+    cache_cookie_policy = "names"
 
     feed_title = "LWN.net"
 
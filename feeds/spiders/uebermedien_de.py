@@ -16,6 +16,7 @@ class UebermedienDeSpider(FeedsXMLFeedSpider):
     start_urls = ["https://uebermedien.de/feed/"]
     namespaces = [("dc", "http://purl.org/dc/elements/1.1/")]
     custom_settings = {"COOKIES_ENABLED": True}
+    cache_cookie_policy = "names"
 
     feed_title = "Übermedien"
     feed_subtitle = "Medien besser kritisieren."
@@ -29,6 +29,7 @@ setup(
     extras_require={
         "docs": ["sphinx", "sphinx_rtd_theme"],
         "test": ["pytest"],
+        "zstd": ["zstandard"],
     },
     entry_points={"console_scripts": ["feeds=feeds.cli:main"]},
     classifiers=[
@@ -0,0 +1,957 @@
+import os
+import pickle
+import sqlite3
+import threading
+from datetime import timedelta
+from unittest.mock import Mock, patch
+
+import pytest
+from scrapy import Request, Spider
+from scrapy.extensions.httpcache import FilesystemCacheStorage
+from scrapy.http import HtmlResponse
+from scrapy.settings import Settings
+from scrapy.statscollectors import MemoryStatsCollector
+from scrapy.utils.misc import load_object
+from scrapy.utils.request import fingerprint
+
+from feeds.cache import (
+    _RECORD_HEADER,
+    FeedsCache,
+    FeedsCacheIndex,
+    FeedsCacheLRU,
+    FeedsCacheObjectStore,
+    FeedsCacheRemovals,
+    FeedsCacheStorage,
+    FeedsPackCacheStorage,
+    FeedsSqliteCacheStorage,
+    FingerprintChain,
+    _CacheRecord,
+    _decode_record,
+    _encode_record,
+    _Pack,
+    cache_fingerprint,
+)
+from feeds.downloadermiddlewares import FeedsHttpCacheMiddleware
+from feeds.spidermiddlewares import (
+    FeedsHttpCacheMiddleware as SpiderFeedsHttpCacheMiddleware,
+)
+
+
+@pytest.fixture
+def settings(tmp_path):
+    return Settings(
+        {
+            "HTTPCACHE_DIR": str(tmp_path),
+            "HTTPCACHE_EXPIRATION_SECS": 90 * 24 * 60 * 60,
+            "HTTPCACHE_IGNORE_HTTP_CODES": list(range(400, 600)),
+        }
+    )
+
+
+@pytest.fixture
+def spider():
+    return Spider(name="example.com")
+
+
+def _request(url, parents=(), **meta):
+    request = Request(url, meta=meta)
+    chain = None
+    for parent in parents:
+        chain = FingerprintChain(fingerprint(parent), chain)
+    request.meta["fingerprints"] = FingerprintChain(
+        fingerprint(request, include_headers=["Cookie"]), chain
+    )
+    return request
+
+
+def _response(request, status=200, body=b"<html>body</html>"):
+    return HtmlResponse(request.url, status=status, body=body, request=request)
+
+
+def test_sqlite_store_retrieve_response(settings, spider):
+    storage = FeedsSqliteCacheStorage(settings)
+    request = _request("https://example.com/article")
+    assert storage.retrieve_response(spider, request) is None
+
+    storage.store_response(spider, request, _response(request))
+    response = storage.retrieve_response(spider, request)
+    assert isinstance(response, HtmlResponse)
+    assert response.status == 200
+    assert response.body == b"<html>body</html>"
+
+
+def test_sqlite_ignore_http_codes(settings, spider):
+    storage = FeedsSqliteCacheStorage(settings)
+    request = _request("https://example.com/missing")
+    storage.store_response(spider, request, _response(request, status=404))
+    assert storage.retrieve_response(spider, request) is None
+
+
+def test_sqlite_objects(settings, spider):
+    storage = FeedsSqliteCacheStorage(settings)
+    assert storage.retrieve_object(spider, "key") is None
+    storage.store_object(spider, "key", {"a": 1})
+    assert storage.retrieve_object(spider, "key") == {"a": 1}
+
+
+def test_sqlite_remove_response_removes_parents(settings, spider):
+    storage = FeedsSqliteCacheStorage(settings)
+    parent = _request("https://example.com/index")
+    storage.store_response(spider, parent, _response(parent))
+    child = _request("https://example.com/article", parents=[parent])
+    response = _response(child)
+    storage.store_response(spider, child, response)
+
+    storage.remove_response(response, spider)
+    assert storage.retrieve_response(spider, child) is None
+    assert storage.retrieve_response(spider, parent) is None
+
+
+def test_sqlite_cleanup(settings, spider):
+    storage = FeedsSqliteCacheStorage(settings)
+    fresh = _request("https://example.com/fresh")
+    storage.store_response(spider, fresh, _response(fresh))
+    expired = _request("https://example.com/expired", cache_expires=timedelta(0))
+    storage.store_response(spider, expired, _response(expired))
+    storage.db.execute("UPDATE entries SET timestamp = timestamp - 10")
+
+    assert storage.cleanup().removed == 1
+    assert storage.retrieve_response(spider, fresh) is not None
+    assert storage.retrieve_response(spider, expired) is None
+
+
+def test_sqlite_import_filesystem_cache(settings, spider):
+    fs_storage = FeedsCacheStorage(settings)
+    request = _request("https://example.com/article")
+    fs_storage.store_response(spider, request, _response(request))
+    fs_storage.store_object(spider, "key", "value")
+
+    storage = FeedsSqliteCacheStorage(settings)
+    assert storage.import_filesystem_cache() == 2
+    assert storage.retrieve_response(spider, request).body == b"<html>body</html>"
+    assert storage.retrieve_object(spider, "key") == "value"
+
+
+def test_filesystem_cleanup_uses_index(settings, spider):
+    storage = FeedsCacheStorage(settings)
+    fresh = _request("https://example.com/fresh")
+    storage.store_response(spider, fresh, _response(fresh))
+    expired = _request("https://example.com/expired", cache_expires=timedelta(0))
+    storage.store_response(spider, expired, _response(expired))
+    storage.index.db.execute("UPDATE entries SET timestamp = timestamp - 10")
+    storage.index.mark_built()
+
+    stats = storage.cleanup()
+    assert storage.retrieve_response(spider, fresh) is not None
+    assert storage.retrieve_response(spider, expired) is None
+    assert (stats.scanned, stats.removed) == (1, 1)
+    assert stats.bytes_freed > 0
+
+
+@pytest.mark.parametrize(
+    "storage_cls",
+    [FeedsCacheStorage, FeedsSqliteCacheStorage, FeedsPackCacheStorage],
+)
+def test_cleanup_only_given_spiders(settings, storage_cls):
+    storage = storage_cls(settings)
+    # 404 responses are removed by cleanup but not served by retrieve_response.
+    storage.ignore_http_codes = []
+    spiders = [Spider(name="example.com"), Spider(name="example.org")]
+    for spider in spiders:
+        request = _request("https://example.com/missing")
+        storage.store_response(spider, request, _response(request, status=404))
+
+    storage_cls(settings).cleanup(["example.com"])
+    assert storage.retrieve_response(spiders[0], request) is None
+    assert storage.retrieve_response(spiders[1], request) is not None
+
+
+@pytest.mark.parametrize("threads", [1, 4])
+def test_filesystem_cleanup_removes_in_threads(settings, spider, threads):
+    settings.set("HTTPCACHE_CLEANUP_THREADS", threads)
+    storage = FeedsCacheStorage(settings)
+    storage.ignore_http_codes = []
+    requests = [_request(f"https://example.com/{i}") for i in range(50)]
+    for request in requests:
+        storage.store_response(spider, request, _response(request, status=404))
+    storage.index.mark_built()
+
+    stats = FeedsCacheStorage(settings).cleanup()
+    assert (stats.scanned, stats.removed) == (50, 50)
+    assert stats.bytes_freed > 0
+    for request in requests:
+        assert storage.retrieve_response(spider, request) is None
+    # Empty bucket directories are removed as well.
+    assert os.listdir(os.path.join(storage.cachedir, spider.name)) == []
+
+
+def test_object_store_flushes_are_serialized(tmp_path):
+    path = str(tmp_path / "objects")
+    spider_store = FeedsCacheObjectStore(path, 60 * 60)
+    spider_store.set("key", "value")
+    # A cleanup flushes the store while the spider is still running.
+    cleanup_store = FeedsCacheObjectStore(path, 60 * 60)
+    replace = os.replace
+    threads = []
+
+    def replace_and_flush_spider_store(src, dst):
+        if not threads:
+            threads.append(threading.Thread(target=spider_store.flush))
+            threads[0].start()
+            # The spider's flush waits for the cleanup to finish.
+            threads[0].join(0.1)
+            assert threads[0].is_alive()
+        replace(src, dst)
+
+    with patch("feeds.cache.os.replace", replace_and_flush_spider_store):
+        cleanup_store.flush(force=True)
+        threads[0].join()
+    assert FeedsCacheObjectStore(path, 60 * 60).get("key") is not None
+
+
+def test_cache_cleanup_is_rate_limited(settings, spider):
+    settings.set("HTTPCACHE_ENABLED", True)
+    settings.set("HTTPCACHE_STORAGE", "feeds.cache.FeedsCacheStorage")
+    storage = FeedsCacheStorage(settings)
+    storage.ignore_http_codes = []
+    request = _request("https://example.com/missing")
+    storage.store_response(spider, request, _response(request, status=404))
+    FeedsCache(settings).cleanup([spider.name], min_interval=60 * 60)
+    assert storage.retrieve_response(spider, request) is None
+
+    storage.store_response(spider, request, _response(request, status=404))
+    FeedsCache(settings).cleanup([spider.name], min_interval=60 * 60)
+    assert storage.retrieve_response(spider, request) is not None
+    FeedsCache(settings).cleanup()
+    assert storage.retrieve_response(spider, request) is None
+
+
+def test_filesystem_cleanup_evicts_over_quota(settings, spider):
+    settings.set("FEEDS_SPIDER_EXAMPLE_COM_CACHE_QUOTA", 1)
+    storage = FeedsCacheStorage(settings)
+    body = b"x" * 400 * 1024
+    requests = [_request(f"https://example.com/{i}") for i in range(3)]
+    for request in requests:
+        storage.store_response(spider, request, _response(request, body=body))
+    # Entries are evicted in order of their last access.
+    storage.retrieve_response(spider, requests[0])
+    storage.index.mark_built()
+
+    storage.cleanup()
+    assert storage.retrieve_response(spider, requests[0]) is not None
+    assert storage.retrieve_response(spider, requests[1]) is None
+    assert storage.retrieve_response(spider, requests[2]) is not None
+
+
+def test_filesystem_quota_charges_blobs(settings, spider):
+    settings.set("HTTPCACHE_DEDUPLICATE", True)
+    settings.set("FEEDS_SPIDER_EXAMPLE_COM_CACHE_QUOTA", 1)
+    storage = FeedsCacheStorage(settings)
+    body = os.urandom(400 * 1024)
+    requests = [_request(f"https://example.com/{i}") for i in range(3)]
+    for request in requests:
+        storage.store_response(spider, request, _response(request, body=body))
+    assert storage.index.sizes()[spider.name] > 3 * len(body)
+    storage.index.mark_built()
+
+    storage.cleanup()
+    assert storage.retrieve_response(spider, requests[0]) is None
+    assert storage.retrieve_response(spider, requests[1]) is not None
+    assert storage.retrieve_response(spider, requests[2]) is not None
+
+
+def test_filesystem_cleanup_without_quota_skips_sizes(settings, spider):
+    storage = FeedsCacheStorage(settings)
+    request = _request("https://example.com/article")
+    storage.store_response(spider, request, _response(request))
+    storage.index.mark_built()
+
+    with patch.object(storage.index, "sizes") as sizes:
+        storage.cleanup([spider.name])
+        storage.cleanup()
+    sizes.assert_not_called()
+
+    settings.set("FEEDS_SPIDER_OTHER_COM_CACHE_QUOTA", 1)
+    with patch.object(storage.index, "sizes", return_value={}) as sizes:
+        storage.cleanup([spider.name])
+        sizes.assert_not_called()
+        storage.cleanup()
+    sizes.assert_called_once_with()
+
+
+def test_filesystem_cleanup_builds_index(settings, spider):
+    storage = FeedsCacheStorage(settings)
+    missing = _request("https://example.com/missing")
+    storage.store_response(spider, missing, _response(missing, status=404))
+    # Simulate a cache that was created before the index existed.
+    storage.index.db.execute("DELETE FROM entries")
+
+    stats = storage.cleanup()
+    assert storage.index.built
+    assert (stats.scanned, stats.removed) == (2, 1)
+    assert storage._read_record(storage._get_request_path(spider, missing)) is None
+
+
+def test_filesystem_index_is_not_dropped_by_other_connections(settings, spider):
+    storage = FeedsCacheStorage(settings)
+    requests = [_request(f"https://example.com/{i}") for i in range(5)]
+    for request in requests:
+        storage.store_response(spider, request, _response(request))
+    assert not storage.index.built
+
+    # E.g. the storage of another crawl or of the cleanup thread.
+    other = FeedsCacheStorage(settings)
+    assert not other.index.built
+    count = "SELECT COUNT(*) FROM entries"
+    assert storage.index.db.execute(count).fetchone()[0] == 5
+
+
+def test_filesystem_index_rebuild_keeps_new_entries(settings, spider):
+    storage = FeedsCacheStorage(settings)
+    old = _request("https://example.com/old")
+    storage.store_response(spider, old, _response(old))
+    other = FeedsCacheStorage(settings)
+    new = _request("https://example.com/new")
+
+    old_key = cache_fingerprint(old, spider).hex()
+
+    def entries():
+        yield spider.name, old_key, 0, None, 200, None, 10, []
+        # Stored while the cache is read.
+        other.store_response(spider, new, _response(new))
+
+    storage.index.rebuild(entries(), [])
+    assert storage.index.built
+    keys = {row[0] for row in storage.index.db.execute("SELECT key FROM entries")}
+    assert keys == {old_key, cache_fingerprint(new, spider).hex()}
+
+
+def test_filesystem_index_is_migrated(settings, spider, tmp_path):
+    index = FeedsCacheIndex(os.path.join(tmp_path, "index.sqlite"))
+    # Index of version 1.
+    index._db = sqlite3.connect(index.path, isolation_level=None)
+    index._db.executescript(
+        "CREATE TABLE entries (spider TEXT NOT NULL, key TEXT NOT NULL, "
+        "timestamp REAL NOT NULL, cache_expires REAL, status INTEGER, "
+        "PRIMARY KEY (spider, key)); "
+        "INSERT INTO entries VALUES ('example.com', 'key', 0, NULL, 200);"
+    )
+    index._db.close()
+    index._db = None
+
+    storage = FeedsCacheStorage(settings)
+    assert not storage.index.built
+    storage.index.add("example.com", "other", 0, size=10)
+    assert dict(storage.index.db.execute("SELECT key, size FROM entries")) == {
+        "key": 0,
+        "other": 10,
+    }
+
+
+def test_filesystem_remove_response_removes_parents(settings, spider):
+    storage = FeedsCacheStorage(settings)
+    parents = [_request("https://example.com/index"), _request("https://example.com/")]
+    for parent in parents:
+        storage.store_response(spider, parent, _response(parent))
+    # Parents of older entries are kept.
+    for parent in parents:
+        child = _request("https://example.com/article", parents=[parent])
+        response = _response(child)
+        storage.store_response(spider, child, response)
+
+    storage.remove_response(response, spider)
+    assert storage.retrieve_response(spider, child) is None
+    for parent in parents:
+        assert storage.retrieve_response(spider, parent) is None
+
+
+def test_filesystem_single_file_entries(settings, spider):
+    storage = FeedsCacheStorage(settings)
+    request = _request("https://example.com/article", cache_expires=timedelta(days=1))
+    storage.store_response(spider, request, _response(request))
+    path = storage._get_request_path(spider, request)
+    assert os.path.isfile(path)
+    assert not os.path.exists(f"{path}.meta")
+
+    record = storage._read_record(path)
+    assert record.status == 200
+    assert record.cache_expires == 24 * 60 * 60
+    assert record.url == "https://example.com/article"
+    response = storage.retrieve_response(spider, request)
+    assert response.body == b"<html>body</html>"
+    assert response.headers == {}
+
+
+def test_filesystem_debug_meta(settings, spider):
+    settings.set("HTTPCACHE_DEBUG_META", True)
+    storage = FeedsCacheStorage(settings)
+    request = _request("https://example.com/article")
+    storage.store_response(spider, request, _response(request))
+    path = storage._get_request_path(spider, request)
+    with open(f"{path}.meta") as f:
+        assert "'status': 200" in f.read()
+
+
+def test_filesystem_reads_legacy_entries(settings, spider):
+    storage = FeedsCacheStorage(settings)
+    request = _request("https://example.com/article")
+    FilesystemCacheStorage.store_response(storage, spider, request, _response(request))
+    assert os.path.isdir(storage._get_request_path(spider, request))
+
+    assert storage.retrieve_response(spider, request).body == b"<html>body</html>"
+    # Storing it again replaces the directory.
+    storage.store_response(spider, request, _response(request, body=b"new"))
+    assert storage.retrieve_response(spider, request).body == b"new"
+
+
+def test_filesystem_writes_records_atomically(settings, spider):
+    storage = FeedsCacheStorage(settings)
+    request = _request("https://example.com/article")
+    storage.store_response(spider, request, _response(request))
+    path = storage._get_request_path(spider, request)
+
+    with patch("feeds.cache.os.replace", side_effect=OSError):
+        with pytest.raises(OSError):
+            storage.store_response(spider, request, _response(request, body=b"new"))
+    assert storage.retrieve_response(spider, request).body == b"<html>body</html>"
+    assert os.listdir(os.path.dirname(path)) == [os.path.basename(path)]
+
+
+def test_filesystem_cleanup_removes_stale_temporary_files(settings, spider):
+    storage = FeedsCacheStorage(settings)
+    request = _request("https://example.com/article")
+    storage.store_response(spider, request, _response(request))
+    storage.index.mark_built()
+    bucket = os.path.dirname(storage._get_request_path(spider, request))
+    tmp_root = os.path.join(storage.cachedir, "_tmp")
+    assert os.listdir(tmp_root) == []
+    # Left over by killed processes, also next to the entries by older versions.
+    stale = [os.path.join(tmp_root, "1-2-key"), os.path.join(bucket, "key.1.tmp")]
+    fresh = os.path.join(tmp_root, "3-4-key")
+    for path in stale + [fresh]:
+        with open(path, "wb") as f:
+            f.write(b"partial")
+    for path in stale:
+        os.utime(path, (0, 0))
+
+    assert storage.cleanup().bytes_freed == len(b"partial")
+    assert os.listdir(tmp_root) == ["3-4-key"]
+    # Legacy temporary files are removed when the index is built.
+    storage.index.db.execute("PRAGMA user_version = 0")
+    storage.cleanup()
+    assert not os.path.exists(stale[1])
+    assert storage.retrieve_response(spider, request) is not None
+
+
+@pytest.mark.parametrize("data", [b"", b"FEED", b"x" * 100])
+def test_filesystem_corrupt_records_are_removed(settings, spider, data):
+    storage = FeedsCacheStorage(settings)
+    corrupt = _request("https://example.com/corrupt")
+    storage.store_response(spider, corrupt, _response(corrupt))
+    path = storage._get_request_path(spider, corrupt)
+    with open(path, "wb") as f:
+        f.write(data)
+
+    assert storage.retrieve_response(spider, corrupt) is None
+    assert not os.path.exists(path)
+
+    # Corrupt records don't abort building the index.
+    storage.store_response(spider, corrupt, _response(corrupt))
+    with open(path, "wb") as f:
+        f.write(data)
+    ok = _request("https://example.com/ok")
+    storage.store_response(spider, ok, _response(ok))
+    storage.index.db.execute("DELETE FROM entries")
+    assert storage.cleanup().scanned == 1
+    assert storage.retrieve_response(spider, ok) is not None
+
+
+@pytest.mark.parametrize("compression", ["none", "gzip"])
+def test_filesystem_compression(settings, spider, compression):
+    settings.set("HTTPCACHE_COMPRESSION", compression)
+    storage = FeedsCacheStorage(settings)
+    request = _request("https://example.com/article")
+    body = b"<html>" + b"body" * 1000 + b"</html>"
+    storage.store_response(spider, request, _response(request, body=body))
+    assert storage.retrieve_response(spider, request).body == body
+
+    size = os.path.getsize(storage._get_request_path(spider, request))
+    assert (size < len(body)) == (compression != "none")
+
+    # Entries stay readable if the codec changes.
+    settings.set("HTTPCACHE_COMPRESSION", "none" if compression == "gzip" else "gzip")
+    assert FeedsCacheStorage(settings).retrieve_response(spider, request).body == body
+
+
+def test_sqlite_compression(settings, spider):
+    settings.set("HTTPCACHE_COMPRESSION", "gzip")
+    storage = FeedsSqliteCacheStorage(settings)
+    request = _request("https://example.com/article")
+    body = b"<html>" + b"body" * 1000 + b"</html>"
+    storage.store_response(spider, request, _response(request, body=body))
+    assert storage.retrieve_response(spider, request).body == body
+    (size,) = storage.db.execute("SELECT length(body) FROM entries").fetchone()
+    assert size < len(body)
+
+
+def test_filesystem_deduplicate(settings, spider):
+    settings.set("HTTPCACHE_DEDUPLICATE", True)
+    settings.set("HTTPCACHE_DEDUPLICATE_MIN_SIZE", 0)
+    storage = FeedsCacheStorage(settings)
+    storage.index.mark_built()
+    requests = [_request("https://example.com/a"), _request("https://example.com/b")]
+    responses = [_response(request) for request in requests]
+    for request, response in zip(requests, responses):
+        storage.store_response(spider, request, response)
+    blobs_root = os.path.join(settings["HTTPCACHE_DIR"], "_blobs")
+    assert sum(len(files) for _, _, files in os.walk(blobs_root)) == 1
+    for request in requests:
+        assert storage.retrieve_response(spider, request).body == b"<html>body</html>"
+
+    storage.remove_response(responses[0], spider)
+    storage.cleanup()
+    assert storage.retrieve_response(spider, requests[1]).body == b"<html>body</html>"
+
+    storage.remove_response(responses[1], spider)
+    storage.cleanup()
+    assert sum(len(files) for _, _, files in os.walk(blobs_root)) == 0
+
+
+def test_pack_store_retrieve(settings, spider):
+    storage = FeedsPackCacheStorage(settings)
+    request = _request("https://example.com/article")
+    assert storage.retrieve_response(spider, request) is None
+    storage.store_response(spider, request, _response(request))
+    storage.store_object(spider, "key", {"a": 1})
+    assert storage.retrieve_response(spider, request).body == b"<html>body</html>"
+    assert storage.retrieve_object(spider, "key") == {"a": 1}
+
+    # The index is restored from the index file and the segment tail.
+    pack = storage._get_pack(spider.name)
+    pack.save_index()
+    other = _request("https://example.com/other")
+    storage.store_response(spider, other, _response(other, body=b"other"))
+    entries = dict(pack.entries)
+    assert _Pack(pack.path).entries == entries
+
+
+def test_pack_remove_and_compact(settings, spider):
+    storage = FeedsPackCacheStorage(settings)
+    parent = _request("https://example.com/index")
+    storage.store_response(spider, parent, _response(parent))
+    child = _request("https://example.com/article", parents=[parent])
+    response = _response(child)
+    storage.store_response(spider, child, response)
+    kept = _request("https://example.com/kept")
+    storage.store_response(spider, kept, _response(kept))
+
+    storage.remove_response(response, spider)
+    assert storage.retrieve_response(spider, child) is None
+    assert storage.retrieve_response(spider, parent) is None
+
+    pack = storage._get_pack(spider.name)
+    assert pack.garbage_ratio > 0.5
+    pack.compact()
+    assert pack.garbage_ratio == 0
+    assert storage.retrieve_response(spider, kept).body == b"<html>body</html>"
+    assert _Pack(pack.path).entries == pack.entries
+
+
+def _record(i, body=None):
+    record = _CacheRecord(
+        "object", None, i, None, [], None, None, None, b"", body or b"x" * i
+    )
+    return _encode_record(record)
+
+
+def test_pack_compact_while_reading(tmp_path):
+    pack = _Pack(str(tmp_path))
+    errors = []
+    done = threading.Event()
+
+    def read():
+        try:
+            while not done.is_set():
+                for key in list(pack.entries):
+                    pack.read(key)
+        except Exception as e:
+            errors.append(e)
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    try:
+        for i in range(20):
+            for j in range(50):
+                key = f"{j:020d}".encode()
+                # Maps of reads are too small for the records appended later.
+                pack.append(key, _record(i))
+                pack.read(key)
+            pack.compact()
+    finally:
+        done.set()
+        reader.join()
+    assert not errors
+    assert pack.read(f"{0:020d}".encode()) == _record(19)
+
+
+def test_pack_shared_by_processes(tmp_path):
+    # Packs of different processes only share the files.
+    a, b = _Pack(str(tmp_path)), _Pack(str(tmp_path))
+    key_a, key_b = b"a" * 20, b"b" * 20
+    a.append(key_a, _record(1, b"from A"))
+    b.append(key_b, _record(2, b"from B"))
+    a.append(key_a, _record(3, b"from A again"))
+    assert _decode_record(b.read(key_b)).body == b"from B"
+    assert _decode_record(a.read(key_a)).body == b"from A again"
+    # Records of other processes are found after writing.
+    b.remove(key_b)
+    assert _decode_record(b.read(key_a)).body == b"from A again"
+
+    a.compact()
+    b.append(key_b, _record(4, b"from B again"))
+    assert _decode_record(b.read(key_a)).body == b"from A again"
+    a.close()
+    b.close()
+    assert _Pack(str(tmp_path)).entries == a.entries == b.entries
+
+
+def test_pack_incomplete_frame_is_cut_off(tmp_path):
+    pack = _Pack(str(tmp_path))
+    pack.append(b"a" * 20, _record(1))
+    pack.close()
+    segment = os.path.join(tmp_path, "00000001.seg")
+    size = os.path.getsize(segment)
+    # Interrupted write.
+    with open(segment, "ab") as f:
+        f.write(b"b" * 20 + b"\0\xff\xff")
+
+    pack = _Pack(str(tmp_path))
+    assert os.path.getsize(segment) == size
+    pack.append(b"c" * 20, _record(2))
+    assert _Pack(str(tmp_path)).entries == pack.entries
+
+
+def test_pack_corrupt_records_are_removed(settings, spider):
+    storage = FeedsPackCacheStorage(settings)
+    request = _request("https://example.com/article")
+    storage.store_response(spider, request, _response(request))
+    pack = storage._get_pack(spider.name)
+    key = cache_fingerprint(request, spider)
+    corrupt = b"FEED" + bytes(_RECORD_HEADER.size)
+    pack.append(key, corrupt)
+
+    assert storage.retrieve_response(spider, request) is None
+    assert pack.read(key) is None
+    pack.append(key, corrupt)
+    storage.remove_response(_response(request), spider)
+    pack.append(key, corrupt)
+    storage.store_response(spider, request, _response(request))
+    assert storage.retrieve_response(spider, request) is not None
+
+
+def test_pack_cleanup_without_cache_dir(settings, tmp_path):
+    settings.set("HTTPCACHE_DIR", str(tmp_path / "missing"))
+    stats = FeedsPackCacheStorage(settings).cleanup()
+    assert (stats.scanned, stats.removed) == (0, 0)
+
+
+def test_cache_object_store(settings, spider):
+    settings.set("HTTPCACHE_ENABLED", True)
+    settings.set("HTTPCACHE_STORAGE", "feeds.cache.FeedsCacheStorage")
+    cache = FeedsCache(settings)
+    assert cache.setdefault(spider, "key", "a") == "a"
+    assert cache.setdefault(spider, "key", "b") == "a"
+    path = os.path.join(settings["HTTPCACHE_DIR"], spider.name, "objects")
+    assert not os.path.exists(path)
+
+    cache.close_spider(spider)
+    assert os.path.isfile(path)
+    assert FeedsCache(settings).get(spider, "key") == "a"
+
+
+def test_cache_object_store_reads_legacy_objects(settings, spider):
+    settings.set("HTTPCACHE_ENABLED", True)
+    settings.set("HTTPCACHE_STORAGE", "feeds.cache.FeedsCacheStorage")
+    FeedsCacheStorage(settings).store_object(spider, "key", "legacy")
+    cache = FeedsCache(settings)
+    assert cache.get(spider, "key") == "legacy"
+    cache.close_spider(spider)
+    data = FeedsCache(settings)._get_store(spider.name).get("key")
+    assert pickle.loads(data) == "legacy"
+
+
+def test_lru_evicts_least_recently_used():
+    lru = FeedsCacheLRU(max_bytes=10)
+    lru.set("a", 1, 4)
+    lru.set("b", 2, 4)
+    assert lru.get("a") == 1
+    lru.set("c", 3, 4)
+    assert "b" not in lru
+    assert lru.get("a") == 1 and lru.get("c") == 3
+    assert lru.size == 8
+    # Items larger than the limit are not kept.
+    lru.set("d", 4, 11)
+    assert "d" not in lru and len(lru) == 2
+
+
+def test_cache_in_memory_storage_is_bounded(settings, spider):
+    settings.set("HTTPCACHE_ENABLED", False)
+    settings.set("FEEDS_CONFIG_CACHE_MEMORY_LIMIT", 1)
+    cache = FeedsCache(settings)
+    cache.set(spider, "key", "value")
+    assert cache.get(spider, "key") == "value"
+    for i in range(1024):
+        cache.set(spider, i, b"x" * 1024)
+    assert cache.get(spider, "key") is None
+    assert cache.storage.data.size <= 1024 * 1024
+
+
+def test_revalidate_uncached_request(settings, spider):
+    settings.setdict(
+        {
+            "HTTPCACHE_ENABLED": True,
+            "HTTPCACHE_STORAGE": "feeds.cache.FeedsCacheStorage",
+            "HTTPCACHE_POLICY": "feeds.cache.FeedsCachePolicy",
+            "HTTPCACHE_REVALIDATE": True,
+        }
+    )
+    mw = FeedsHttpCacheMiddleware(settings, Mock())
+    mw.crawler = Mock(spider=spider)
+
+    request = Request("https://example.com/feed", meta={"dont_cache": True})
+    assert mw.process_request(request) is None
+    assert "If-None-Match" not in request.headers
+    response = HtmlResponse(
+        request.url, body=b"<feed/>", headers={"ETag": '"v1"'}, request=request
+    )
+    assert mw.process_response(request, response) is response
+
+    request = Request("https://example.com/feed", meta={"dont_cache": True})
+    assert mw.process_request(request) is None
+    assert request.headers["If-None-Match"] == b'"v1"'
+    response = mw.process_response(
+        request, HtmlResponse(request.url, status=304, request=request)
+    )
+    assert response.status == 200
+    assert response.body == b"<feed/>"
+    assert "revalidated" in response.flags
+
+
+def test_filesystem_stats(settings, spider):
+    spider.crawler = Mock()
+    spider.crawler.stats = MemoryStatsCollector(Mock(settings=settings))
+    storage = FeedsCacheStorage(settings)
+    request = _request("https://example.com/article")
+    assert storage.retrieve_response(spider, request) is None
+    storage.store_response(spider, request, _response(request))
+    assert storage.retrieve_response(spider, request) is not None
+    storage.close_spider(spider)
+
+    stats = spider.crawler.stats.get_stats()
+    assert stats["feeds_cache/hit"] == 1
+    assert stats["feeds_cache/miss"] == 1
+    assert stats["feeds_cache/store"] == 1
+    assert stats["feeds_cache/bytes_read"] == stats["feeds_cache/bytes_written"]
+    assert "feeds_cache/retrieve_response/p99_ms" in stats
+
+
+def test_stale_if_error(settings, spider):
+    settings.setdict(
+        {
+            "HTTPCACHE_ENABLED": True,
+            "HTTPCACHE_STORAGE": "feeds.cache.FeedsCacheStorage",
+            "HTTPCACHE_POLICY": "feeds.cache.FeedsCachePolicy",
+            "HTTPCACHE_STALE_IF_ERROR": True,
+            "RETRY_ENABLED": True,
+            "RETRY_TIMES": 1,
+            "RETRY_HTTP_CODES": [503],
+        }
+    )
+    mw = FeedsHttpCacheMiddleware(settings, Mock())
+    mw.crawler = Mock(spider=spider)
+
+    request = Request("https://example.com/feed", meta={"dont_cache": True})
+    mw.process_request(request)
+    mw.process_response(request, HtmlResponse(request.url, body=b"<feed/>"))
+
+    request = Request("https://example.com/feed", meta={"dont_cache": True})
+    mw.process_request(request)
+    assert "If-None-Match" not in request.headers
+    # The request is retried first.
+    response = HtmlResponse(request.url, status=503)
+    assert mw.process_response(request, response) is response
+
+    request = Request(
+        "https://example.com/feed", meta={"dont_cache": True, "retry_times": 1}
+    )
+    mw.process_request(request)
+    response = mw.process_exception(request, TimeoutError())
+    assert response.body == b"<feed/>"
+    assert "stale" in response.flags
+
+
+@pytest.mark.parametrize(
+    "storage_cls",
+    [FeedsCacheStorage, FeedsSqliteCacheStorage, FeedsPackCacheStorage],
+)
+def test_negative_cache(settings, spider, storage_cls):
+    settings.set("HTTPCACHE_NEGATIVE_HTTP_CODES", [404])
+    settings.set("HTTPCACHE_NEGATIVE_EXPIRATION_SECS", 60 * 60)
+    storage = storage_cls(settings)
+    missing = _request("https://example.com/missing")
+    storage.store_response(spider, missing, _response(missing, status=404))
+    error = _request("https://example.com/error")
+    storage.store_response(spider, error, _response(error, status=500))
+
+    storage.cleanup()
+    assert storage.retrieve_response(spider, missing).status == 404
+    assert storage.retrieve_response(spider, error) is None
+
+    # Let the negative cache entry expire.
+    storage.negative_cache.expiration_secs = -1
+    assert storage.retrieve_response(spider, missing) is None
+    storage.cleanup()
+    storage.ignore_http_codes = []
+    assert storage.retrieve_response(spider, missing) is None
+
+
+def test_cache_fingerprint_cookie_policy(spider):
+    def request(cookie=None):
+        return Request(
+            "https://example.com/", headers={"Cookie": cookie} if cookie else {}
+        )
+
+    session1 = request("session=1; theme=dark")
+    session2 = request("theme=light; session=2")
+    assert cache_fingerprint(session1, spider) != cache_fingerprint(session2, spider)
+
+    spider.cache_cookie_policy = "names"
+    assert cache_fingerprint(session1, spider) == cache_fingerprint(session2, spider)
+    assert cache_fingerprint(session1, spider) != cache_fingerprint(request(), spider)
+
+    spider.cache_cookie_policy = "ignore"
+    assert cache_fingerprint(session1, spider) == cache_fingerprint(request(), spider)
+
+
+def test_cache_fingerprint_is_computed_once(spider):
+    request = Request("https://example.com/", headers={"Cookie": "session=1"})
+    fpr = cache_fingerprint(request, spider)
+    assert cache_fingerprint(request, spider) is fpr
+    spider.cache_cookie_policy = "ignore"
+    assert cache_fingerprint(request, spider) != fpr
+
+
+def test_fingerprint_chain_is_shared(settings, spider):
+    settings.set("HTTPCACHE_ENABLED", True)
+    settings.set("HTTPCACHE_STORAGE", "feeds.cache.FeedsCacheStorage")
+    mw = SpiderFeedsHttpCacheMiddleware(settings)
+    index = Request("https://example.com/")
+    mw.request_scheduled(index, spider)
+    articles = list(
+        mw.process_spider_output(
+            _response(index),
+            [Request(f"https://example.com/{i}") for i in range(2)],
+            spider,
+        )
+    )
+    for article in articles:
+        mw.request_scheduled(article, spider)
+        assert article.meta["fingerprints"].parent is index.meta["fingerprints"]
+        assert list(article.meta["fingerprints"]) == [
+            cache_fingerprint(index, spider),
+            cache_fingerprint(article, spider),
+        ]
+    # The chain survives serialization, e.g. to a disk queue.
+    chain = pickle.loads(pickle.dumps(articles[0].meta["fingerprints"]))
+    assert list(chain) == list(articles[0].meta["fingerprints"])
+
+
+@pytest.mark.parametrize(
+    "storage_cls",
+    [FeedsCacheStorage, FeedsSqliteCacheStorage, FeedsPackCacheStorage],
+)
+def test_remove_responses(settings, spider, storage_cls):
+    storage = storage_cls(settings)
+    parent = _request("https://example.com/index")
+    storage.store_response(spider, parent, _response(parent))
+    responses = []
+    for i in range(3):
+        child = _request(f"https://example.com/{i}", parents=[parent])
+        responses.append(_response(child))
+        storage.store_response(spider, child, responses[-1])
+    kept = _request("https://example.com/kept")
+    storage.store_response(spider, kept, _response(kept))
+
+    storage.remove_responses(responses, spider)
+    for response in responses:
+        assert storage.retrieve_response(spider, response.request) is None
+    assert storage.retrieve_response(spider, parent) is None
+    assert storage.retrieve_response(spider, kept) is not None
+
+
+def test_remove_responses_before_index_is_built(settings, spider):
+    storage = FeedsCacheStorage(settings)
+    parent = _request("https://example.com/index")
+    storage.store_response(spider, parent, _response(parent))
+    child = _request("https://example.com/article", parents=[parent])
+    response = _response(child)
+    storage.store_response(spider, child, response)
+    # Entries stored by older versions are not in the index until the next
+    # cleanup, their parents are read from the entries.
+    storage.index.db.executescript("DELETE FROM parents; PRAGMA user_version = 0")
+
+    storage.remove_responses([response], spider)
+    assert storage.retrieve_response(spider, child) is None
+    assert storage.retrieve_response(spider, parent) is None
+
+
+@pytest.mark.parametrize(
+    "storage_cls",
+    [FeedsCacheStorage, FeedsSqliteCacheStorage, FeedsPackCacheStorage],
+)
+def test_removals_are_collapsed(settings, spider, storage_cls):
+    settings.set("HTTPCACHE_STORAGE", f"feeds.cache.{storage_cls.__name__}")
+    spider.crawler = Mock()
+    spider.crawler.stats = MemoryStatsCollector(Mock(settings=settings))
+    storage = storage_cls(settings)
+    parent = _request("https://example.com/index")
+    storage.store_response(spider, parent, _response(parent))
+    removals = FeedsCacheRemovals(settings)
+    for i in range(3):
+        child = _request(f"https://example.com/{i}", parents=[parent])
+        response = _response(child)
+        storage.store_response(spider, child, response)
+        # Every item of a response is dropped.
+        removals.add(response, spider)
+        removals.add(response, spider)
+    assert len(removals) == 3
+
+    # Only fingerprints are queued, not responses.
+    assert list(removals._pending[spider]) == [
+        cache_fingerprint(_request(f"https://example.com/{i}"), spider)
+        for i in range(3)
+    ]
+
+    removals._remove(list(removals._pending[spider]), spider)
+    assert storage.retrieve_response(spider, parent) is None
+    stats = spider.crawler.stats.get_stats()
+    assert stats["feeds_cache/remove_response"] == 3
+    # 3 duplicate responses and 2 removals of the shared parent.
+    assert stats["feeds_cache/removals_collapsed"] == 5
+
+
+def test_removals_reuse_and_close_storage(settings, spider):
+    settings.set("HTTPCACHE_STORAGE", "feeds.cache.FeedsSqliteCacheStorage")
+    removals = FeedsCacheRemovals(settings)
+    fingerprints = [cache_fingerprint(_request("https://example.com/article"), spider)]
+
+    with patch("feeds.cache.load_object", wraps=load_object) as load:
+        removals._remove(fingerprints, spider)
+        removals._remove(fingerprints, spider)
+        assert load.call_count == 1
+    storage = removals._storage
+    assert storage._db is not None
+
+    removals._close_storage()
+    assert storage._db is None
+    assert removals._storage is None
@@ -0,0 +1,73 @@
+from unittest.mock import Mock, patch
+
+from click.testing import CliRunner
+from twisted.internet import defer
+from twisted.internet.error import ReactorNotRunning
+
+from feeds.cli import cli
+
+
+def _crawl(tmp_path, monkeypatch, reactor, cache_storage="filesystem"):
+    monkeypatch.setenv("SCRAPY_SETTINGS_MODULE", "feeds.default_settings")
+    config = tmp_path / "feeds.cfg"
+    config.write_text(
+        "[feeds]\n"
+        f"cache_dir = {tmp_path}\n"
+        "cache_enabled = 1\n"
+        f"cache_storage = {cache_storage}\n"
+        "cache_cleanup_background = 1\n"
+    )
+    process = Mock()
+    process.join.return_value = defer.Deferred()
+
+    with patch("feeds.cli.CrawlerProcess", return_value=process), patch(
+        "feeds.cli.deferToThread", side_effect=defer.maybeDeferred
+    ), patch("twisted.internet.reactor", reactor, create=True):
+        result = CliRunner().invoke(
+            cli, ["-c", str(config), "crawl", "example.com"], obj={}
+        )
+
+    assert result.exit_code == 0, result.output
+    process.crawl.assert_called_once_with("example.com")
+    return process
+
+
+def test_crawl_cleans_up_cache_in_background(tmp_path, monkeypatch):
+    reactor = Mock()
+    process = _crawl(tmp_path, monkeypatch, reactor)
+    # The cleanup doesn't stop the reactor while the spiders are running.
+    process.start.assert_called_once_with(stop_after_crawl=False)
+    reactor.stop.assert_not_called()
+    # Only the cache of spiders that ran is cleaned up.
+    assert (tmp_path / "example.com" / "cleaned").exists()
+
+    # The reactor is stopped once crawling and cleaning up are done.
+    process.join.return_value.callback(None)
+    reactor.stop.assert_called_once_with()
+
+
+def test_crawl_does_not_stop_stopping_reactor(tmp_path, monkeypatch):
+    # The reactor is already stopping, e.g. after a signal.
+    reactor = Mock()
+    reactor.stop.side_effect = ReactorNotRunning
+    deferreds = []
+
+    def deferred_list(*args):
+        deferreds.append(defer.DeferredList(*args))
+        return deferreds[-1]
+
+    with patch("feeds.cli.DeferredList", deferred_list):
+        process = _crawl(tmp_path, monkeypatch, reactor)
+    process.join.return_value.callback(None)
+    reactor.stop.assert_called_once_with()
+    failures = []
+    deferreds[0].addErrback(failures.append)
+    assert failures == []
+
+
+def test_crawl_cleans_up_pack_cache_after_crawling(tmp_path, monkeypatch):
+    reactor = Mock()
+    process = _crawl(tmp_path, monkeypatch, reactor, cache_storage="pack")
+    process.start.assert_called_once_with()
+    process.join.assert_not_called()
+    assert (tmp_path / "example.com" / "cleaned").exists()
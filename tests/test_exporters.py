@@ -0,0 +1,245 @@
+import filecmp
+import hashlib
+import os
+import random
+import tempfile
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+import pytest
+from lxml import etree
+
+from feeds.exporters import AtomExporter
+from feeds.items import FeedEntryItem, FeedItem
+
+ATOM = "{http://www.w3.org/2005/Atom}"
+
+
+@pytest.fixture
+def export(tmp_path, monkeypatch):
+    if not hasattr(AtomExporter, "_get_serialized_fields"):
+        # Renamed in newer Scrapy versions.
+        monkeypatch.setattr(
+            AtomExporter,
+            "_get_serialized_fields",
+            AtomExporter.get_serialized_fields,
+            raising=False,
+        )
+
+    def export(items, name="example.com", pretty_print=True, header=True, **kwargs):
+        exporter = AtomExporter(
+            str(tmp_path), "https://feeds.example.com/", name, **kwargs
+        )
+        exporter._pretty_print = pretty_print
+        exporter.start_exporting()
+        if header:
+            exporter.export_item(
+                FeedItem(
+                    id="https://example.com",
+                    title="Example",
+                    link="https://example.com",
+                )
+            )
+        for item in items:
+            exporter.export_item(item.copy())
+        exporter.finish_exporting()
+        return tmp_path / name / "feed.atom"
+
+    return export
+
+
+def _entry(i, day=None, **fields):
+    fields = {
+        "id": f"https://example.com/{i}",
+        "title": f"Entry {i}",
+        "link": f"https://example.com/{i}",
+        "updated": datetime(2020, 1, 1, tzinfo=timezone.utc)
+        + timedelta(days=i if day is None else day),
+        **fields,
+    }
+    return FeedEntryItem(**fields)
+
+
+def _regression_items():
+    updated = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    for i in range(6):
+        yield FeedEntryItem(
+            id=f"tag:example.com,2024:{i % 5}",
+            title=f"Über <{i}> €",
+            # Entries with the same date keep their order.
+            updated=updated + timedelta(hours=i % 3),
+            link=f"https://example.com/{i}",
+            author_name="Jane Doe",
+            author_email="jane@example.com",
+            content_html=f"<p>Entry {i} &amp; more</p>",
+            category=["news", "world"],
+            enclosure=[{"iri": "https://example.com/image.png", "type": "image/png"}],
+            path=["", "news"] if i % 2 else [""],
+        )
+    yield FeedItem(
+        id="https://example.com",
+        title="Example",
+        subtitle="News from example.com",
+        link="https://example.com",
+        author_name="Example",
+        icon="https://example.com/favicon.ico",
+        logo="https://example.com/logo.png",
+        path=["", "news"],
+    )
+
+
+def _entries(path):
+    return etree.parse(str(path)).getroot().findall(f"{ATOM}entry")
+
+
+def _titles(path):
+    return [entry.findtext(f"{ATOM}title") for entry in _entries(path)]
+
+
+@pytest.mark.parametrize("pretty_print", [True, False])
+def test_output(export, tmp_path, pretty_print):
+    export(_regression_items(), pretty_print=pretty_print, header=False)
+    style = "pretty" if pretty_print else "compact"
+    for path, fixture in (("", "feed"), ("news", "news")):
+        with open(tmp_path / "example.com" / path / "feed.atom", "rb") as f:
+            output = f.read()
+        with open(f"tests/fixtures/atom_exporter/{fixture}.{style}.atom", "rb") as f:
+            assert output == f.read()
+
+
+def _spill_files():
+    """Patch TemporaryFile() and collect the temporary files of the exporter."""
+    files = []
+    create = tempfile.TemporaryFile
+
+    def temporary_file(*args, **kwargs):
+        files.append(create(*args, **kwargs))
+        return files[-1]
+
+    return files, patch("feeds.exporters.tempfile.TemporaryFile", temporary_file)
+
+
+def test_feeds_share_spill_file(export, tmp_path):
+    items = [_entry(i, path=["", "news", "sport"]) for i in range(3)]
+    files, patcher = _spill_files()
+    with patcher:
+        export(items)
+    assert len(files) == 1
+    assert files[0].closed
+    for path in ("", "news", "sport"):
+        titles = _titles(tmp_path / "example.com" / path / "feed.atom")
+        assert titles == ["Entry 2", "Entry 1", "Entry 0"]
+
+
+def test_failed_write_leaves_no_files(export, tmp_path):
+    files, patcher = _spill_files()
+    with patch.object(AtomExporter.AtomFeed, "write", side_effect=OSError), patcher:
+        with pytest.raises(OSError):
+            export([_entry(1, path=["", "news"])])
+    assert files[0].closed
+    assert os.listdir(tmp_path / "example.com") == []
+
+
+def test_unchanged_feed_is_not_rewritten(export, tmp_path):
+    path = export([_entry(1)])
+    digest_path = tmp_path / "example.com" / ".feed.atom.sha256"
+    digest = digest_path.read_text()
+    os.utime(path, (0, 0))
+
+    export([_entry(1)])
+    assert os.stat(path).st_mtime == 0
+    assert digest_path.read_text() == digest
+    assert sorted(os.listdir(path.parent)) == [".feed.atom.sha256", "feed.atom"]
+
+
+def test_digest_is_updated_when_feed_is_replaced(export, tmp_path):
+    path = export([_entry(1)])
+    digest_path = tmp_path / "example.com" / ".feed.atom.sha256"
+    digest = digest_path.read_text()
+
+    export([_entry(1), _entry(2)])
+    assert "Entry 2" in path.read_text()
+    assert digest_path.read_text() == hashlib.sha256(path.read_bytes()).hexdigest()
+    assert digest_path.read_text() != digest
+
+
+def test_feed_without_digest_is_compared_once(export, tmp_path):
+    path = export([_entry(1)])
+    digest_path = tmp_path / "example.com" / ".feed.atom.sha256"
+    digest = digest_path.read_text()
+    # Feeds written by older versions have no digest.
+    digest_path.unlink()
+    os.utime(path, (0, 0))
+
+    with patch("feeds.exporters.filecmp.cmp", wraps=filecmp.cmp) as cmp:
+        export([_entry(1)])
+        assert cmp.call_count == 1
+        assert os.stat(path).st_mtime == 0
+        assert digest_path.read_text() == digest
+
+        export([_entry(1)])
+        assert cmp.call_count == 1
+    assert os.stat(path).st_mtime == 0
+
+
+def test_failed_digest_write_leaves_no_files(export, tmp_path):
+    path = export([_entry(1)])
+    replace = os.replace
+
+    def replace_feed_only(src, dst):
+        if dst.endswith(".sha256"):
+            raise OSError
+        replace(src, dst)
+
+    with patch("feeds.exporters.os.replace", replace_feed_only):
+        with pytest.raises(OSError):
+            export([_entry(1), _entry(2)])
+    assert sorted(os.listdir(path.parent)) == [".feed.atom.sha256", "feed.atom"]
+
+
+def test_max_entries_keeps_newest_entries(export):
+    items = [_entry(i) for i in range(10)]
+    random.Random(0).shuffle(items)
+    path = export(items, max_entries=3)
+    assert _titles(path) == ["Entry 9", "Entry 8", "Entry 7"]
+
+
+def test_max_entries_per_path(export, tmp_path):
+    items = [_entry(i, path=["", "news"]) for i in range(10)]
+    export(items, max_entries=3, max_entries_per_path={"news": 5})
+    assert len(_entries(tmp_path / "example.com" / "feed.atom")) == 3
+    assert len(_entries(tmp_path / "example.com" / "news" / "feed.atom")) == 5
+
+
+def test_first_entry_with_id_wins(export):
+    items = [
+        _entry(1, title="first"),
+        _entry(1, day=5, title="second"),
+        _entry(2),
+    ]
+    assert _titles(export(items)) == ["Entry 2", "first"]
+
+
+def test_first_entry_with_id_wins_if_rejected(export):
+    items = [_entry(i) for i in range(3)]
+    # Too old for the full feed; a newer entry with the same id is dropped too
+    # like it would be without max_entries.
+    items.append(_entry(-1, title="old"))
+    items.append(_entry(-1, day=5, title="new"))
+    assert _titles(export(items, max_entries=3)) == ["Entry 2", "Entry 1", "Entry 0"]
+
+
+@pytest.mark.parametrize("max_entries", [1, 5, 20, 50])
+def test_max_entries_equals_newest_entries_of_unbounded_feed(export, max_entries):
+    rnd = random.Random(max_entries)
+    # Duplicate ids and dates with ties.
+    items = [_entry(rnd.randrange(30), day=rnd.randrange(10)) for _ in range(40)]
+    unbounded = [
+        etree.tostring(entry, with_tail=False)
+        for entry in _entries(export(items, name="unbounded"))
+    ]
+    bounded = [
+        etree.tostring(entry, with_tail=False)
+        for entry in _entries(export(items, name="bounded", max_entries=max_entries))
+    ]
+    assert bounded == unbounded[:max_entries]
@@ -0,0 +1,34 @@
+import pytest
+from scrapy import Spider
+from scrapy.settings import Settings
+
+from feeds.pipelines import AtomExportPipeline
+
+
+def _spider(**settings):
+    spider = Spider(name="example.com")
+    spider.settings = Settings(settings)
+    return spider
+
+
+def test_max_entries_defaults_to_global_setting():
+    pipeline = AtomExportPipeline("/tmp", None)
+    spider = _spider(FEEDS_CONFIG_MAX_ENTRIES=100)
+    assert pipeline._get_max_entries(spider) == (100, {})
+
+
+def test_max_entries_per_path():
+    pipeline = AtomExportPipeline("/tmp", None)
+    spider = _spider(
+        FEEDS_CONFIG_MAX_ENTRIES=100,
+        FEEDS_SPIDER_EXAMPLE_COM_MAX_ENTRIES="\n50\nnews 10\n\n  sport   5  \n",
+    )
+    assert pipeline._get_max_entries(spider) == (50, {"news": 10, "sport": 5})
+
+
+@pytest.mark.parametrize("line", ["news", "news ten", "news sport 10", "1.5"])
+def test_max_entries_invalid_line(line):
+    pipeline = AtomExportPipeline("/tmp", None)
+    spider = _spider(FEEDS_SPIDER_EXAMPLE_COM_MAX_ENTRIES=f"50\n{line}")
+    with pytest.raises(ValueError, match="Invalid max_entries setting of spider"):
+        pipeline._get_max_entries(spider)